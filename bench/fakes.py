@@ -0,0 +1,55 @@
+import threading
+import time
+
+
+# Stands in for telegram.Bot and records everything the bot sends.
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+        self.lock = threading.Lock()
+
+    def send_message(self, chat_id, text, **kwargs):
+        with self.lock:
+            self.sent.append((chat_id, text))
+
+    def send_photo(self, chat_id, photo, **kwargs):
+        with self.lock:
+            self.sent.append((chat_id, photo))
+
+    def clear(self):
+        with self.lock:
+            self.sent = []
+
+
+class FakeChat:
+    def __init__(self, chat_id, username=None, first_name=None):
+        self.id = chat_id
+        self.username = username
+        self.first_name = first_name
+
+
+class FakeUpdate:
+    def __init__(self, chat_id):
+        self.effective_chat = FakeChat(chat_id)
+
+
+class FakeContext:
+    def __init__(self, bot, args=None):
+        self.bot = bot
+        self.args = args or []
+
+
+# Stands in for the time module in bot.py: time() returns a simulated clock that only moves
+# when advance() is called, everything else is the real time module.
+class FakeClock:
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+    def __getattr__(self, name):
+        return getattr(time, name)
@@ -0,0 +1,97 @@
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# The default accept backlog of 5 overflows under the bot's concurrent downloads, and every
+# refused connection waits about a second for the SYN to be sent again.
+class PageHTTPServer(ThreadingHTTPServer):
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+# Local stand-in for the monitored sites. Serves pages /page/<number>; every request
+# changes the page with probability change_rate. Pages answer conditional requests
+# with 304 and are spread over hosts 127.0.0.1, 127.0.0.2, ... so that the per-host
+# limits of the bot behave like they would against real sites.
+class PageServer:
+    def __init__(self, pages, change_rate=0.1, latency=0.0, size=10000, hosts=1, seed=0):
+        self.pages = pages
+        self.change_rate = change_rate
+        self.latency = latency
+        self.size = size
+        self.hosts = hosts
+        self.versions = [0] * pages
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.server = None
+
+    def start(self):
+        self.server = PageHTTPServer(('', 0), self.create_handler())
+        threading.Thread(target=self.server.serve_forever, name='page-server', daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def url(self, number):
+        host = "127.0.0." + str(number % self.hosts + 1)
+        return "http://%s:%d/page/%d" % (host, self.server.server_port, number)
+
+    def urls(self):
+        return [self.url(number) for number in range(self.pages)]
+
+    # Returns the current version of the page, changing it first with probability change_rate.
+    def next_version(self, number):
+        with self.lock:
+            self.requests += 1
+            if self.random.random() < self.change_rate:
+                self.versions[number] += 1
+            return self.versions[number]
+
+    def body(self, number, version):
+        line = "Page %d, version %d. Lorem ipsum dolor sit amet, consectetur adipiscing elit.\n" % (number, version)
+        return (line * (self.size // len(line) + 1))[:self.size].encode('utf-8')
+
+    def create_handler(self):
+        pages = self
+
+        class PageHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                parts = self.path.strip('/').split('/')
+                if len(parts) != 2 or parts[0] != 'page' or not parts[1].isdigit() \
+                        or int(parts[1]) >= pages.pages:
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+                if pages.latency:
+                    threading.Event().wait(pages.latency)
+
+                number = int(parts[1])
+                version = pages.next_version(number)
+                etag = '"%d-%d"' % (number, version)
+
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+                body = pages.body(number, version)
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('ETag', etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return PageHandler
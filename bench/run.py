@@ -0,0 +1,232 @@
+import argparse
+import os
+import resource
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+
+# Benchmarks the monitor tick and the command handlers of bot.py without Telegram or
+# the internet: pages come from a local PageServer, messages go to a FakeBot and the
+# data goes to a temporary SQLite database or, with --database-url, to a throwaway
+# PostgreSQL database (all its bot tables are emptied!).
+#
+# Example:
+#   python -m bench.run --scales 100,1000,10000
+#   python -m bench.run --database-url postgresql://localhost/avro_bench --scales 100,1000,10000
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the monitor tick and command handlers.")
+    parser.add_argument('--database-url', default=os.environ.get('BENCH_DATABASE_URL'),
+                        help="throwaway PostgreSQL database, defaults to BENCH_DATABASE_URL "
+                             "or a temporary SQLite database")
+    parser.add_argument('--scales', default='100,1000,10000,100000',
+                        help="comma separated numbers of subscriptions")
+    parser.add_argument('--subscribers-per-page', type=int, default=5)
+    parser.add_argument('--urls-per-chat', type=int, default=20)
+    parser.add_argument('--change-rate', type=float, default=0.1,
+                        help="probability that a page changes between two requests")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds every page takes to answer")
+    parser.add_argument('--page-size', type=int, default=10000, help="page size in bytes")
+    parser.add_argument('--hosts', type=int, default=20, help="number of hosts the pages are spread over")
+    parser.add_argument('--ticks', type=int, default=3, help="measured monitor ticks per scale")
+    parser.add_argument('--commands', type=int, default=50, help="measured /follow and /list calls per scale")
+    parser.add_argument('--schedule-seconds', type=int, default=300,
+                        help="simulated seconds of monitor ticks on the real schedule per scale")
+    return parser.parse_args()
+
+
+def configure_environment(args):
+    if not args.database_url:
+        args.database_url = 'sqlite:///' + os.path.join(tempfile.mkdtemp(prefix='avro_bench'), 'bench.db')
+
+    # bot.py reads its configuration on import
+    os.environ['DATABASE_URL'] = args.database_url
+    os.environ.setdefault('DATABASE_SSLMODE', 'disable')
+    os.environ.setdefault('CREATOR_ID', '0')
+    os.environ.setdefault('LOG_LEVEL', 'ERROR')
+    os.environ.setdefault('RESPONSE_CACHE_TTL', '0')
+    os.environ.setdefault('MONITOR_MAX_BATCH', str(10 ** 9))
+    os.environ.setdefault('NOTIFY_RATE', '1000000')
+    os.environ.setdefault('NOTIFY_CHAT_INTERVAL', '0')
+    os.environ.setdefault('NOTIFY_COALESCE_WINDOW', '0.05')
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def peak_memory_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def report(scale, phase, operations, latencies):
+    total = sum(latencies)
+    print("%9d  %-8s %8d %10.2f %12.1f %9.1f %9.1f %9.1f %11.1f" % (
+        scale, phase, operations, total, operations / total if total else 0.0,
+        percentile(latencies, 0.5) * 1000, percentile(latencies, 0.95) * 1000,
+        percentile(latencies, 0.99) * 1000, peak_memory_mb()))
+
+
+def reset_database(bot):
+    bot.init_database()
+
+    with bot.storage.transaction() as cursor:
+        for table in ['snapshots', 'subscriptions', 'urls', 'user_comments']:
+            cursor.execute("delete from " + table)
+
+
+def create_subscriptions(bot, pages, scale, urls_per_chat):
+    urls = pages.urls()
+    chats = {}
+    for number in range(scale):
+        chats.setdefault(number // urls_per_chat + 1, {})[urls[number % len(urls)]] = None
+
+    for chat_id, chat_urls in chats.items():
+        bot.storage.add_subscriptions(chat_id, [(url, None, None) for url in chat_urls])
+
+    return sum(len(chat_urls) for chat_urls in chats.values()), max(chats)
+
+
+# Makes every monitored url due, so that the next tick checks all of them.
+def make_all_due(bot, urls):
+    with bot.poll_schedule_lock:
+        bot.poll_schedule.clear()
+        bot.poll_next_check.clear()
+        bot.poll_intervals.clear()
+
+    for url in urls:
+        bot.schedule_url(url, 0, bot.POLL_MIN_INTERVAL)
+    bot.subscriptions_loaded_at = time.time()
+
+
+# Runs monitor ticks every MONITOR_TICK seconds of a simulated clock, with the schedule, slots
+# and intervals of bot.py, and returns how late every check ran past the interval of the
+# previous check of its url, in seconds.
+def run_schedule(bot, urls, seconds, clock, context):
+    real_time = bot.time
+    bot.time = clock
+    try:
+        make_all_due(bot, urls)
+        bot.subscriptions_loaded_at = clock.time()
+
+        checked_at = {}
+        lateness = []
+        for _ in range(seconds // bot.MONITOR_TICK):
+            with bot.poll_schedule_lock:
+                before = dict(bot.poll_next_check)
+                intervals = dict(bot.poll_intervals)
+
+            bot.callback_minute(context)
+
+            with bot.poll_schedule_lock:
+                after = dict(bot.poll_next_check)
+
+            now = clock.time()
+            for url, next_check in after.items():
+                if before.get(url) == next_check:
+                    continue
+                if url in checked_at:
+                    lateness.append(now - checked_at[url] - intervals[url])
+                checked_at[url] = now
+
+            clock.advance(bot.MONITOR_TICK)
+    finally:
+        bot.time = real_time
+
+    return lateness
+
+
+def wait_for_notifications(bot):
+    while bot.notification_queue.qsize():
+        time.sleep(0.01)
+
+
+def run_scale(bot, args, scale, fake_bot, fakes, PageServer):
+    pages = PageServer(max(1, scale // args.subscribers_per_page), args.change_rate, args.latency,
+                       args.page_size, args.hosts)
+    pages.start()
+
+    try:
+        reset_database(bot)
+        subscriptions, last_chat_id = create_subscriptions(bot, pages, scale, args.urls_per_chat)
+        bot.reload_subscriptions()
+        urls = pages.urls()
+
+        # The first tick stores hashes, validators and snapshots of every page
+        make_all_due(bot, urls)
+        bot.callback_minute(fakes.FakeContext(fake_bot))
+        wait_for_notifications(bot)
+
+        latencies = []
+        notifications = 0
+        for _ in range(args.ticks):
+            fake_bot.clear()
+            make_all_due(bot, urls)
+            started = time.perf_counter()
+            bot.callback_minute(fakes.FakeContext(fake_bot))
+            latencies.append(time.perf_counter() - started)
+            wait_for_notifications(bot)
+            notifications += len(fake_bot.sent)
+
+        # For the tick, throughput is in checked urls per second
+        total = sum(latencies)
+        print("%9d  %-8s %8d %10.2f %12.1f %9.1f %9.1f %9.1f %11.1f   (%d subscriptions, %d notifications)" % (
+            scale, 'tick', len(urls) * args.ticks, total, len(urls) * args.ticks / total if total else 0.0,
+            percentile(latencies, 0.5) * 1000, percentile(latencies, 0.95) * 1000,
+            percentile(latencies, 0.99) * 1000, peak_memory_mb(), subscriptions, notifications))
+
+        latencies = []
+        for number in range(args.commands):
+            context = fakes.FakeContext(fake_bot, [urls[number % len(urls)]])
+            started = time.perf_counter()
+            bot.follow(fakes.FakeUpdate(last_chat_id + 1 + number), context)
+            latencies.append(time.perf_counter() - started)
+        report(scale, 'follow', args.commands, latencies)
+
+        latencies = []
+        for number in range(args.commands):
+            started = time.perf_counter()
+            bot.list_all(fakes.FakeUpdate(number % last_chat_id + 1), fakes.FakeContext(fake_bot))
+            latencies.append(time.perf_counter() - started)
+        report(scale, 'list', args.commands, latencies)
+
+        # For the schedule, the latencies are how late the checks ran past their interval
+        started = time.perf_counter()
+        lateness = run_schedule(bot, urls, args.schedule_seconds, fakes.FakeClock(time.time()),
+                                fakes.FakeContext(fake_bot))
+        total = time.perf_counter() - started
+        wait_for_notifications(bot)
+        print("%9d  %-8s %8d %10.2f %12.1f %9.1f %9.1f %9.1f %11.1f   (lateness, %d s simulated)" % (
+            scale, 'schedule', len(lateness), total, len(lateness) / total if total else 0.0,
+            percentile(lateness, 0.5) * 1000, percentile(lateness, 0.95) * 1000,
+            percentile(lateness, 0.99) * 1000, peak_memory_mb(), args.schedule_seconds))
+
+    finally:
+        pages.stop()
+
+
+def main():
+    args = parse_args()
+    configure_environment(args)
+
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+    import bot
+    from bench import fakes
+    from bench.pages import PageServer
+
+    fake_bot = fakes.FakeBot()
+    bot.start_notification_worker(fake_bot)
+
+    # ru_maxrss only grows, so the memory column is the peak of the process up to the end of the phase
+    print("    scale  phase         ops    total s        ops/s    p50 ms    p95 ms    p99 ms  max RSS MB")
+    for scale in [int(scale) for scale in args.scales.split(',')]:
+        run_scale(bot, args, scale, fake_bot, fakes, PageServer)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,54 +1,933 @@
 import telegram
+import tornado.ioloop
+import tornado.web
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from prometheus_client import Counter, Gauge, Histogram, CONTENT_TYPE_LATEST, generate_latest
+from telegram.error import BadRequest, RetryAfter, NetworkError, TelegramError
 from telegram.ext import Updater, MessageHandler, Filters
-from telegram.ext import CommandHandler
+from telegram.ext import CommandHandler, CallbackQueryHandler
 
 # Uncomment if you're using built-in logging.
 #import logging
 
+import asyncio
+import atexit
+import difflib
 import hashlib
+import heapq
+import hmac
+import html
+import queue
+import random
+import re
+import zlib
 import requests
 import os
-import psycopg2 as pscg
+import signal
+import socket
+import sys
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime as dt
-from urllib.request import Request, urlopen
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
 from pathlib import Path
 from termcolor import colored
+from storage import StorageError, open_storage
 
 
+# Startup is measured from here, see STARTUP_SECONDS.
+process_started_at = time.monotonic()
+
 kraljevo_path = Path.cwd().joinpath('resources').joinpath('kraljevo.jpg')
+log_path = Path().resolve().joinpath("log").joinpath("log.txt")
 
 # Credentials for database connection stored in system variable.
 # Visit https://www3.ntu.edu.sg/home/ehchua/programming/howto/Environment_Variables.html for more info.
+# A DATABASE_URL of the form sqlite:///<path> stores everything in a local SQLite file instead.
 DATABASE_URL = os.environ['DATABASE_URL']
+DATABASE_SSLMODE = os.environ.get('DATABASE_SSLMODE', 'require')
 CREATOR_ID = os.environ['CREATOR_ID']
 
+# Logging: lines are flushed to the log file every LOG_FLUSH_INTERVAL seconds. The file is rotated
+# when it grows over LOG_MAX_BYTES or gets older than LOG_ROTATE_INTERVAL seconds.
+# Use LOG_LEVEL=DEBUG to also log every checked url.
+LOG_DEBUG = 10
+LOG_INFO = 20
+LOG_ERROR = 40
+LOG_LEVEL = {'DEBUG': LOG_DEBUG, 'INFO': LOG_INFO, 'ERROR': LOG_ERROR}.get(os.environ.get('LOG_LEVEL', 'INFO').upper(),
+                                                                         LOG_INFO)
+LOG_FLUSH_INTERVAL = float(os.environ.get('LOG_FLUSH_INTERVAL', '1'))
+LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES', str(5 * 1024 * 1024)))
+LOG_ROTATE_INTERVAL = int(os.environ.get('LOG_ROTATE_INTERVAL', str(24 * 60 * 60)))
+LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT', '5'))
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', '100000'))
+
+log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+log_lock = threading.Lock()
+log_stats = {'dropped': 0, 'opened_at': None}
+
+# Number of dispatcher threads running the run_async command handlers.
+DISPATCHER_WORKERS = int(os.environ.get('DISPATCHER_WORKERS', '4'))
+
+# PostgreSQL connection pool, shared by all handlers and jobs. It is sized for the dispatcher
+# workers plus the jobs. Connections idle for longer than DB_HEALTH_CHECK_INTERVAL seconds
+# are checked before they are handed out. With SQLite, DB_POOL_TIMEOUT is how long a writer
+# waits for another one.
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', str(DISPATCHER_WORKERS + 4)))
+DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', '30'))
+DB_HEALTH_CHECK_INTERVAL = int(os.environ.get('DB_HEALTH_CHECK_INTERVAL', '30'))
+
+# Number of rows sent to the database in one batched statement.
+DB_BATCH_SIZE = int(os.environ.get('DB_BATCH_SIZE', '1000'))
+
+# Fetch engine limits: total number of concurrent downloads and
+# the number of concurrent downloads against a single host.
+FETCH_MAX_WORKERS = int(os.environ.get('FETCH_MAX_WORKERS', '32'))
+FETCH_MAX_PER_HOST = int(os.environ.get('FETCH_MAX_PER_HOST', '4'))
+# /follow downloads on FOLLOW_FETCH_WORKERS threads of their own, so that they do not queue up
+# behind a monitor batch; they still keep to FETCH_MAX_PER_HOST.
+FOLLOW_FETCH_WORKERS = int(os.environ.get('FOLLOW_FETCH_WORKERS', '4'))
+
+# Page bodies are hashed in chunks of FETCH_CHUNK_SIZE bytes; pages larger than
+# FETCH_MAX_BYTES or with a content type outside of the allow-list are not hashed.
+# FINGERPRINT_HASH picks the hash that detects changes, one of fingerprint_hashes.
+FETCH_CHUNK_SIZE = int(os.environ.get('FETCH_CHUNK_SIZE', '65536'))
+FETCH_MAX_BYTES = int(os.environ.get('FETCH_MAX_BYTES', str(10 * 1024 * 1024)))
+FETCH_CONTENT_TYPES = os.environ.get('FETCH_CONTENT_TYPES', 'text/,application/json,application/xml,'
+                                                            'application/xhtml+xml,application/rss+xml,'
+                                                            'application/atom+xml').split(',')
+
+FINGERPRINT_HASH = os.environ.get('FINGERPRINT_HASH', 'crc32')
+
+# Besides the exact hash, pages up to SNAPSHOT_MAX_BYTES get a SimHash of their text, words in
+# shingles of SIMHASH_SHINGLE, without markup. Similar texts have SimHashes that differ in few bits,
+# so followers can choose (/similarity) to be told only about changes that leave a page less
+# similar than their threshold to the version last reported to them. Similarity is 1 for equal
+# SimHashes and 0 for SimHashes as different as those of unrelated texts, which differ in half
+# of their bits.
+SIMHASH_SHINGLE = int(os.environ.get('SIMHASH_SHINGLE', '3'))
+
+# The latest version of every page up to SNAPSHOT_MAX_BYTES is stored compressed, so that
+# notifications can show what changed since it. Older versions are not kept.
+SNAPSHOT_MAX_BYTES = int(os.environ.get('SNAPSHOT_MAX_BYTES', str(512 * 1024)))
+SNAPSHOT_EXCERPT_LINES = int(os.environ.get('SNAPSHOT_EXCERPT_LINES', '10'))
+SNAPSHOT_EXCERPT_LINE_LENGTH = 120
+
+# Per url fetch statuses
+STATUS_OK = 'ok'
+STATUS_NOT_MODIFIED = 'not_modified'
+STATUS_TOO_LARGE = 'too_large'
+STATUS_BAD_CONTENT_TYPE = 'bad_content_type'
+STATUS_UNREACHABLE = 'unreachable'
+
+status_descriptions = {
+    STATUS_TOO_LARGE: "page is larger than %d bytes, not monitored" % FETCH_MAX_BYTES,
+    STATUS_BAD_CONTENT_TYPE: "content type is not supported, not monitored",
+    STATUS_UNREACHABLE: "site is unreachable at the moment",
+}
+
+# All outbound HTTP goes through one session, which keeps FETCH_MAX_PER_HOST
+# connections alive for each of the HTTP_POOL_HOSTS most recently used hosts.
+# A download gives up after HTTP_CONNECT_TIMEOUT seconds without a connection,
+# HTTP_TIMEOUT seconds without data or FETCH_DEADLINE seconds in total.
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', '5'))
+HTTP_TIMEOUT = float(os.environ.get('HTTP_TIMEOUT', '15'))
+FETCH_DEADLINE = float(os.environ.get('FETCH_DEADLINE', '60'))
+HTTP_POOL_HOSTS = int(os.environ.get('HTTP_POOL_HOSTS', '100'))
+
+# After CIRCUIT_FAILURES failed downloads in a row from a host (connection errors,
+# timeouts, 5xx) its circuit opens: the host is not contacted for CIRCUIT_COOLDOWN seconds,
+# then a single download probes whether it is back.
+CIRCUIT_FAILURES = int(os.environ.get('CIRCUIT_FAILURES', '5'))
+CIRCUIT_COOLDOWN = float(os.environ.get('CIRCUIT_COOLDOWN', '60'))
+
+# A url that fails n times in a row is checked again after POLL_MIN_INTERVAL * 2^n seconds,
+# at most POLL_MAX_INTERVAL. Its followers are told that the site is unreachable after
+# UNREACHABLE_NOTICE_AFTER failures in a row and again once it is back (0 turns the notices off).
+UNREACHABLE_NOTICE_AFTER = int(os.environ.get('UNREACHABLE_NOTICE_AFTER', '5'))
+
+# Every url is checked on its own schedule. The monitor job runs every MONITOR_TICK seconds
+# and checks the urls that are due. The interval of a url is halved whenever its page changes
+# and multiplied by POLL_BACKOFF whenever it does not, staying between POLL_MIN_INTERVAL and
+# POLL_MAX_INTERVAL.
+MONITOR_TICK = int(os.environ.get('MONITOR_TICK', '5'))
+POLL_MIN_INTERVAL = int(os.environ.get('POLL_MIN_INTERVAL', '30'))
+POLL_MAX_INTERVAL = int(os.environ.get('POLL_MAX_INTERVAL', '3600'))
+POLL_BACKOFF = float(os.environ.get('POLL_BACKOFF', '1.5'))
+
+# The ticks form a timing wheel of MONITOR_SLOTS slots and every url belongs to one slot,
+# picked by its hash; a url is only checked on the ticks of its slot, so the urls are spread
+# evenly over the ticks. At most MONITOR_MAX_BATCH urls are checked in one tick,
+# the rest stay due for the next one.
+MONITOR_SLOTS = int(os.environ.get('MONITOR_SLOTS', str(max(1, POLL_MIN_INTERVAL // MONITOR_TICK))))
+MONITOR_MAX_BATCH = int(os.environ.get('MONITOR_MAX_BATCH', '500'))
+
+# The schedule, validators and leases are stored with the urls, so a restarted process resumes
+# where the previous one stopped. Urls that became due while it was down are spread over the
+# next STARTUP_JITTER seconds (at most their own interval) instead of all being checked at once.
+STARTUP_JITTER = int(os.environ.get('STARTUP_JITTER', '300'))
+
+# With MONITOR_MODE=local the bot process monitors the urls itself. With MONITOR_MODE=workers
+# it only answers commands and the monitoring is done by worker processes ("python3 bot.py worker"),
+# as many as needed. Workers claim batches of due urls in the database with leases of
+# MONITOR_LEASE seconds, so no url is checked by two workers at once; the leases of a worker
+# that died expire and its urls are claimed by the others. The worker id is unique to the process:
+# during a restart or deploy the old and the new run of a dyno may overlap, and must not take over
+# or save each other's leases. While a batch is being checked its leases are renewed every
+# third of MONITOR_LEASE, so a slow batch is not claimed by another worker meanwhile.
+MONITOR_MODE = os.environ.get('MONITOR_MODE', 'local')
+MONITOR_LEASE = int(os.environ.get('MONITOR_LEASE', '120'))
+WORKER_ID = "%s:%d:%s" % (os.environ.get('DYNO', socket.gethostname()), os.getpid(), os.urandom(4).hex())
+
+# Change notifications go through a delivery queue. A chat gets at most one message per
+# NOTIFY_CHAT_INTERVAL seconds and the bot sends at most NOTIFY_RATE messages per second,
+# to stay under Telegram's flood limits. Notifications for the same chat that arrive within
+# NOTIFY_COALESCE_WINDOW seconds are sent as one message.
+NOTIFY_RATE = float(os.environ.get('NOTIFY_RATE', '25'))
+NOTIFY_CHAT_INTERVAL = float(os.environ.get('NOTIFY_CHAT_INTERVAL', '1'))
+NOTIFY_COALESCE_WINDOW = float(os.environ.get('NOTIFY_COALESCE_WINDOW', '5'))
+NOTIFY_MAX_RETRIES = int(os.environ.get('NOTIFY_MAX_RETRIES', '5'))
+
+# On shutdown (Heroku sends SIGTERM and kills the process 30 seconds later) the queued notifications
+# are sent right away, for at most NOTIFY_DRAIN_TIMEOUT seconds.
+NOTIFY_DRAIN_TIMEOUT = float(os.environ.get('NOTIFY_DRAIN_TIMEOUT', '20'))
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# /list and /list_comments show LIST_PAGE_SIZE entries at a time, in as many messages as needed;
+# the last message of a page has a button that shows the next page.
+LIST_PAGE_SIZE = int(os.environ.get('LIST_PAGE_SIZE', '50'))
+
+# The Prometheus metrics are only served on /metrics when METRICS_TOKEN is set, and only to
+# requests that send it as a bearer token ("Authorization: Bearer <METRICS_TOKEN>"): the webhook
+# host is public and the per-host labels tell which sites are followed.
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+# Worker processes have no webhook server, they serve /metrics on METRICS_PORT
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '9100'))
+
+# Every user can keep at most COMMENT_LIMIT comments. Comments are deleted COMMENT_TTL seconds after
+# they were sent: every COMMENT_PRUNE_INTERVAL seconds the expired ones are deleted in batches of
+# COMMENT_PRUNE_BATCH, each in its own short transaction.
+COMMENT_LIMIT = 30
+COMMENT_TTL = int(os.environ.get('COMMENT_TTL', str(5 * 24 * 60 * 60)))
+COMMENT_PRUNE_INTERVAL = int(os.environ.get('COMMENT_PRUNE_INTERVAL', '600'))
+COMMENT_PRUNE_BATCH = int(os.environ.get('COMMENT_PRUNE_BATCH', '500'))
+
+# /follow downloads are remembered for RESPONSE_CACHE_TTL seconds, so that following the same url
+# again and its first monitor check within that time cost a single download. Only the status, hash and
+# validators are kept, not the text, so a change answered from the cache is reported without an excerpt.
+RESPONSE_CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', '30'))
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', '1000'))
+
+fetch_executor = ThreadPoolExecutor(max_workers=FETCH_MAX_WORKERS, thread_name_prefix='fetch')
+follow_fetch_executor = ThreadPoolExecutor(max_workers=FOLLOW_FETCH_WORKERS, thread_name_prefix='follow-fetch')
+host_semaphores = {}
+host_semaphores_lock = threading.Lock()
+host_circuits = {}
+host_circuits_lock = threading.Lock()
+response_cache = {}
+response_cache_lock = threading.Lock()
+
+# Heap of (next_check, url); entries whose next_check differs from poll_next_check[url] are stale.
+poll_schedule = []
+poll_next_check = {}
+poll_intervals = {}
+poll_schedule_lock = threading.Lock()
+
+# The subscriptions and the last known state of every followed url are kept in memory,
+# so that the monitor and /list do not have to read them from the database. The handlers
+# update the index right after their changes are committed; every SUBSCRIPTIONS_RELOAD_INTERVAL
+# seconds it is reloaded from the database, which catches any drift (e.g. manual changes).
+SUBSCRIPTIONS_RELOAD_INTERVAL = int(os.environ.get('SUBSCRIPTIONS_RELOAD_INTERVAL',
+                                                   os.environ.get('POLL_RELOAD_INTERVAL', '300')))
+
+# Last known state of a followed url, as stored in public.urls.
+UrlState = namedtuple('UrlState', ['url_id', 'hash', 'simhash', 'etag', 'last_modified', 'status', 'failures'])
+
+# url -> set of chat ids, chat id -> urls (a dict, to keep the order they were followed in),
+# url -> UrlState, url -> {chat id: similarity threshold} and url -> {chat id: SimHash of the version
+# last reported to the chat}, the latter two only for the subscriptions that have a threshold
+subscribers = {}
+followed_urls = {}
+url_states = {}
+similarity_thresholds = {}
+similarity_baselines = {}
+subscriptions_lock = threading.Lock()
+subscriptions_loaded_at = 0
+
+# Only one monitor tick runs at a time; ticks that find the previous one still running are skipped.
+monitor_lock = threading.Lock()
+
+notification_queue = queue.Queue()
+notification_stop = threading.Event()
+notification_workers = []
+
+# Prometheus metrics, served on /metrics next to the webhook when METRICS_TOKEN is set.
+MONITOR_TICK_SECONDS = Histogram('avro_monitor_tick_seconds', 'Duration of monitor ticks',
+                                 buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+MONITOR_TICKS_SKIPPED = Counter('avro_monitor_ticks_skipped_total', 'Ticks skipped because the previous one was running')
+MONITOR_URLS_CHECKED = Counter('avro_monitor_urls_checked_total', 'Checked urls by fetch status', ['status'])
+MONITOR_CHANGES = Counter('avro_monitor_changes_total', 'Detected changes, per subscriber')
+MONITOR_CHANGES_SUPPRESSED = Counter('avro_monitor_changes_suppressed_total',
+                                     'Changes below the similarity threshold of every subscriber')
+MONITOR_LEASES_LOST = Counter('avro_monitor_leases_lost_total', 'Checked urls whose lease was lost before the save')
+FETCH_SECONDS = Histogram('avro_fetch_seconds', 'Duration of url downloads', ['host'])
+FETCH_ERRORS = Counter('avro_fetch_errors_total', 'Failed url downloads', ['host'])
+FETCH_SHORT_CIRCUITED = Counter('avro_fetch_short_circuited_total', 'Downloads skipped because the host is down',
+                                ['host'])
+DB_QUERY_SECONDS = Histogram('avro_db_query_seconds', 'Duration of database transactions', ['method'])
+NOTIFICATIONS_QUEUED = Gauge('avro_notifications_queued', 'Notifications waiting in the delivery queue')
+NOTIFICATIONS_QUEUED.set_function(lambda: notification_queue.qsize())
+NOTIFICATIONS_PENDING = Gauge('avro_notifications_pending', 'Notifications waiting for their chat to be ready')
+NOTIFICATION_SEND_SECONDS = Histogram('avro_notification_send_seconds', 'Duration of Telegram send_message calls')
+LOG_LINES_DROPPED = Counter('avro_log_lines_dropped_total', 'Log lines dropped because the log queue was full')
+COMMAND_SECONDS = Histogram('avro_command_seconds', 'Duration of command handlers', ['command'])
+STARTUP_SECONDS = Gauge('avro_startup_seconds', 'Seconds from the process start until it was serving')
+STARTUP_OVERDUE_URLS = Gauge('avro_startup_overdue_urls', 'Urls that were due at startup and got spread out')
 
-# Custom console logging.
-def print_log(text, data = ""):
-    try:
-        with open(Path().resolve().joinpath("log").joinpath("log.txt"), 'a') as f:
-            f.write(str(dt.now().strftime("%I:%M:%S %p")) + ": " + str(text) + ". " + str(data) + "\n")
 
-    except IOError:
-        print(colored(dt.now().strftime("%I:%M:%S %p"), 'cyan'), " ", colored(text, 'magenta'), "can not open log file")
+# Bypass anti-crawler systems by using browser's "identity".
+def create_http_session():
+    session = requests.Session()
+    session.headers.update({'User-Agent': 'Mozilla/5.0', 'Accept-Encoding': 'gzip, deflate'})
+
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=FETCH_MAX_PER_HOST)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+http_session = create_http_session()
+
+
+# Custom logging. Lines are queued and written in batches by a background thread,
+# so callers never wait on the disk; lines are dropped if the queue is full.
+def print_log(text, data = "", level = LOG_INFO):
+    if level < LOG_LEVEL:
+        return
+
+    line = str(dt.now().strftime("%I:%M:%S %p")) + ": " + str(text) + ". " + str(data) + "\n"
+    try:
+        log_queue.put_nowait(line)
+    except queue.Full:
+        log_stats['dropped'] += 1
+        LOG_LINES_DROPPED.inc()
     #print(colored(dt.now().strftime("%I:%M:%S %p"), 'cyan'), " ", colored(text, 'magenta'), data)
 
 
-# Bypass anti-crawler systems by using browser's "identity".
-# Reads an url content and returns a hash value.
-def get_url_hash(url):
-    req = Request(url, headers={'User-Agent': 'Mozilla/5.0'})
-    response = urlopen(req).read()
-    current_hash = hashlib.sha224(response).hexdigest()
-    return current_hash
+# Renames log.txt to log.txt.1, log.txt.1 to log.txt.2 and so on, keeping LOG_BACKUP_COUNT old files.
+def rotate_log_file():
+    for number in range(LOG_BACKUP_COUNT - 1, 0, -1):
+        older = log_path.with_name(log_path.name + "." + str(number))
+        if older.exists():
+            older.replace(log_path.with_name(log_path.name + "." + str(number + 1)))
 
+    if LOG_BACKUP_COUNT > 0:
+        log_path.replace(log_path.with_name(log_path.name + ".1"))
+    else:
+        log_path.unlink()
 
-def is_url_valid(url):
+
+# Writes out everything that is queued and rotates the log file when it grows
+# over LOG_MAX_BYTES or gets older than LOG_ROTATE_INTERVAL seconds.
+def flush_logs():
+    lines = []
     try:
-        requests.get(url)
+        while True:
+            lines.append(log_queue.get_nowait())
+    except queue.Empty:
+        pass
+
+    # Lines dropped because the queue was full are reported in their place
+    dropped, log_stats['dropped'] = log_stats['dropped'], 0
+    if dropped:
+        lines.append(str(dt.now().strftime("%I:%M:%S %p")) + ": Log queue full, lines dropped. " + str(dropped) + "\n")
+
+    if not lines:
+        return
+
+    with log_lock:
+        try:
+            with open(log_path, 'a') as f:
+                f.write("".join(lines))
+                size = f.tell()
+
+            if log_stats['opened_at'] is None:
+                log_stats['opened_at'] = time.time()
+
+            if size > LOG_MAX_BYTES or time.time() - log_stats['opened_at'] > LOG_ROTATE_INTERVAL:
+                rotate_log_file()
+                log_stats['opened_at'] = time.time()
+
+        except IOError:
+            print(colored(dt.now().strftime("%I:%M:%S %p"), 'cyan'), " ", colored(lines[0].strip(), 'magenta'),
+                  "can not open log file")
+
+
+def write_logs():
+    while True:
+        time.sleep(LOG_FLUSH_INTERVAL)
+        flush_logs()
+
+
+def start_log_writer():
+    writer = threading.Thread(target=write_logs, name='log-writer', daemon=True)
+    writer.start()
+
+    # Do not lose the last lines on exit
+    atexit.register(flush_logs)
+
+
+# All database access goes through the storage, which times every transaction by storage method.
+storage = open_storage(DATABASE_URL, DATABASE_SSLMODE, DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT,
+                       DB_HEALTH_CHECK_INTERVAL, DB_BATCH_SIZE, print_log,
+                       lambda name, seconds: DB_QUERY_SECONDS.labels(name).observe(seconds))
+
+
+def log_storage_error(message, e, chat_id=None):
+    print()
+    print_log(e.code, ": " + message)
+    if chat_id is not None:
+        print_log("Chat_id: ", chat_id)
+    print_log("Fail message: ", e.detail)
+    print()
+
+
+# Result of a single url download. Hash is set only when the status is STATUS_OK;
+# if the server confirmed that the content did not change since the last download (304),
+# the status is STATUS_NOT_MODIFIED. Text is the decoded page, if it fits SNAPSHOT_MAX_BYTES.
+FetchResult = namedtuple('FetchResult', ['status', 'hash', 'etag', 'last_modified', 'text'], defaults=[None])
+
+
+# CRC-32 with the hashlib interface; it is not cryptographic, but twice as fast as sha224
+# and collisions between two versions of the same page are negligible.
+class Crc32Hash:
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def hexdigest(self):
+        return "%08x" % self.value
+
+
+# Stored hashes carry the name of their hash, e.g. "crc32:1c291ca3", except for sha224,
+# which was the only one before. A page whose stored hash is of another kind than FINGERPRINT_HASH
+# is not reported as changed, its hash is just replaced.
+fingerprint_hashes = {'crc32': Crc32Hash, 'sha224': hashlib.sha224}
+
+
+def new_fingerprint_hasher():
+    return fingerprint_hashes[FINGERPRINT_HASH]()
+
+
+def fingerprint(hasher):
+    if FINGERPRINT_HASH == 'sha224':
+        return hasher.hexdigest()
+    return FINGERPRINT_HASH + ":" + hasher.hexdigest()
+
+
+def fingerprint_kind(hash_code):
+    return hash_code.split(':')[0] if ':' in hash_code else 'sha224'
+
+
+# Scripts, styles and comments are dropped with their content, other tags without it.
+simhash_hidden = re.compile(r'<(script|style)\b.*?</\1\s*>|<!--.*?-->', re.IGNORECASE | re.DOTALL)
+simhash_tag = re.compile(r'<[^>]*>')
+simhash_word = re.compile(r'\w+')
+
+# simhash_bits[bit][byte] is the given bit of the byte, for counting bits with bytes.translate
+simhash_bits = [bytes((value >> bit) & 1 for value in range(256)) for bit in range(8)]
+
+
+# 64 bit SimHash of the words of a page, as 16 hex digits, None without a text. Every shingle of words
+# is hashed and every bit of the SimHash is set if it is set in the majority of the shingle hashes.
+# It costs a few milliseconds, so it is only computed for pages whose exact hash changed.
+def simhash_text(text):
+    if text is None:
+        return None
+
+    text = html.unescape(simhash_tag.sub(" ", simhash_hidden.sub(" ", text)))
+    words = simhash_word.findall(text.lower())
+    shingles = set(" ".join(words[i:i + SIMHASH_SHINGLE])
+                   for i in range(max(1, len(words) - SIMHASH_SHINGLE + 1)))
+    shingles.discard("")
+    if not shingles:
+        return None
+
+    # digests[byte::8] are the byte-th bytes of all the shingle hashes
+    digests = b"".join(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest() for shingle in shingles)
+    value = 0
+    for byte in range(8):
+        column = digests[byte::8]
+        for bit in range(8):
+            if column.translate(simhash_bits[bit]).count(1) * 2 > len(shingles):
+                value |= 1 << (byte * 8 + bit)
+
+    return "%016x" % value
+
+
+# Similarity of two SimHashes between 0 and 1, None if either of them is missing. Unrelated texts
+# differ in about half of the bits, so anything that far apart or further is 0.
+def simhash_similarity(first, second):
+    if first is None or second is None:
+        return None
+    return max(0.0, 1 - 2 * bin(int(first, 16) ^ int(second, 16)).count('1') / 64)
+
+
+def is_content_type_allowed(content_type):
+    # Servers that do not declare a content type are given the benefit of the doubt
+    if not content_type:
         return True
-    except Exception:
-        return False
+
+    content_type = content_type.split(';')[0].strip().lower()
+    return any(content_type.startswith(allowed.strip()) for allowed in FETCH_CONTENT_TYPES if allowed.strip())
+
+
+# Reads an url content and returns its hash value together with the cache validators.
+# If validators from the previous download are given, the request is conditional
+# and the content is not downloaded at all if it has not changed.
+# The body is streamed through the hasher and only pages up to SNAPSHOT_MAX_BYTES are kept
+# in memory for the snapshot, so memory use does not depend on the page size.
+def fetch_url(url, etag=None, last_modified=None):
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+
+    deadline = time.monotonic() + FETCH_DEADLINE
+
+    with http_session.get(url, headers=headers, stream=True,
+                          timeout=(HTTP_CONNECT_TIMEOUT, HTTP_TIMEOUT)) as response:
+        if response.status_code == 304:
+            return FetchResult(STATUS_NOT_MODIFIED, None, etag, last_modified)
+        response.raise_for_status()
+
+        new_etag = response.headers.get('ETag')
+        new_last_modified = response.headers.get('Last-Modified')
+
+        if not is_content_type_allowed(response.headers.get('Content-Type')):
+            return FetchResult(STATUS_BAD_CONTENT_TYPE, None, new_etag, new_last_modified)
+
+        content_length = response.headers.get('Content-Length')
+        if content_length and content_length.isdigit() and int(content_length) > FETCH_MAX_BYTES:
+            return FetchResult(STATUS_TOO_LARGE, None, new_etag, new_last_modified)
+
+        hasher = new_fingerprint_hasher()
+        size = 0
+        body = []
+        for chunk in response.iter_content(FETCH_CHUNK_SIZE):
+            # The read timeout only limits the wait for each chunk, a server trickling
+            # the page byte by byte is stopped by the deadline
+            if time.monotonic() > deadline:
+                raise requests.Timeout("download took longer than %d seconds" % FETCH_DEADLINE)
+
+            size += len(chunk)
+            if size > FETCH_MAX_BYTES:
+                return FetchResult(STATUS_TOO_LARGE, None, new_etag, new_last_modified)
+
+            hasher.update(chunk)
+
+            if body is not None and size <= SNAPSHOT_MAX_BYTES:
+                body.append(chunk)
+            else:
+                body = None
+
+        text = None
+        if body is not None:
+            text = b"".join(body).decode(response.encoding or 'utf-8', errors='replace')
+
+        return FetchResult(STATUS_OK, fingerprint(hasher), new_etag, new_last_modified, text)
+
+
+def get_host_semaphore(host):
+    with host_semaphores_lock:
+        if host not in host_semaphores:
+            host_semaphores[host] = threading.BoundedSemaphore(FETCH_MAX_PER_HOST)
+        return host_semaphores[host]
+
+
+# Raised instead of downloading from a host whose circuit is open.
+class HostUnavailableError(Exception):
+    pass
+
+
+# Counts the failed downloads in a row from one host and opens after CIRCUIT_FAILURES of them.
+class CircuitBreaker:
+    def __init__(self, failures, cooldown):
+        self.max_failures = failures
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    # Whether the host may be contacted. Once the cooldown is over one download is let
+    # through as a probe, the others wait for another cooldown or for the probe to succeed.
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+
+            now = time.monotonic()
+            if now - self.opened_at >= self.cooldown:
+                self.opened_at = now
+                return True
+
+            return False
+
+    def record(self, success):
+        with self.lock:
+            if success:
+                self.failures = 0
+                self.opened_at = None
+                return
+
+            self.failures += 1
+            if self.failures >= self.max_failures:
+                self.opened_at = time.monotonic()
+
+
+def get_host_circuit(host):
+    with host_circuits_lock:
+        if host not in host_circuits:
+            host_circuits[host] = CircuitBreaker(CIRCUIT_FAILURES, CIRCUIT_COOLDOWN)
+        return host_circuits[host]
+
+
+def fetch_url_limited(url, etag=None, last_modified=None):
+    host = urlsplit(url).netloc.lower()
+    circuit = get_host_circuit(host)
+
+    if not circuit.allow():
+        FETCH_SHORT_CIRCUITED.labels(host).inc()
+        raise HostUnavailableError("host " + host + " is down")
+
+    with get_host_semaphore(host):
+        try:
+            with FETCH_SECONDS.labels(host).time():
+                result = fetch_url(url, etag, last_modified)
+        except (requests.ConnectionError, requests.Timeout):
+            FETCH_ERRORS.labels(host).inc()
+            circuit.record(False)
+            raise
+        except requests.HTTPError as e:
+            FETCH_ERRORS.labels(host).inc()
+            # Client errors are the url's fault, not the host's
+            circuit.record(e.response is not None and e.response.status_code < 500)
+            raise
+        except Exception:
+            FETCH_ERRORS.labels(host).inc()
+            raise
+
+    circuit.record(True)
+    return result
+
+
+def get_cached_response(url):
+    with response_cache_lock:
+        entry = response_cache.get(url)
+        if entry is None:
+            return None
+
+        expires_at, result = entry
+        if expires_at < time.monotonic():
+            del response_cache[url]
+            return None
+
+        return result
+
+
+def cache_response(url, result):
+    now = time.monotonic()
+
+    with response_cache_lock:
+        response_cache.pop(url, None)
+        response_cache[url] = (now + RESPONSE_CACHE_TTL, result._replace(text=None))
+
+        # Entries are kept in insertion order, so the oldest ones, expired or beyond the size, go first
+        while response_cache:
+            oldest = next(iter(response_cache))
+            if response_cache[oldest][0] >= now and len(response_cache) <= RESPONSE_CACHE_SIZE:
+                break
+            del response_cache[oldest]
+
+
+# Same as fetch_url, but answers from the response cache if the url was downloaded recently;
+# with cache the download is added to it. Failed downloads and 304 responses are not cached.
+def fetch_url_cached(url, etag=None, last_modified=None, cache=False):
+    result = get_cached_response(url)
+    if result is not None:
+        return result
+
+    result = fetch_url_limited(url, etag, last_modified)
+    if cache and result.status != STATUS_NOT_MODIFIED:
+        cache_response(url, result)
+
+    return result
+
+
+# Downloads and hashes all urls concurrently on the executor, at most FETCH_MAX_WORKERS at a time
+# by default, and at most FETCH_MAX_PER_HOST against the same host.
+# Takes a dict url -> (etag, last_modified) and returns a dict url -> FetchResult;
+# result is None if the url could not be fetched. With cache the downloads go into the response cache.
+def fetch_urls(validators, executor=fetch_executor, cache=False):
+    # Interleave urls by host, so that workers waiting on a busy host
+    # do not hold up the urls of other hosts
+    by_host = {}
+    for url in validators:
+        by_host.setdefault(urlsplit(url).netloc.lower(), []).append(url)
+
+    ordered = []
+    while by_host:
+        for host in list(by_host):
+            ordered.append(by_host[host].pop())
+            if not by_host[host]:
+                del by_host[host]
+
+    futures = {url: executor.submit(fetch_url_cached, url, *validators[url], cache=cache) for url in ordered}
+
+    results = {}
+    for url, future in futures.items():
+        try:
+            results[url] = future.result()
+        except Exception as e:
+            print_log("Failed to fetch url: ", url + " (" + str(e) + ")")
+            results[url] = None
+
+    return results
+
+
+# Moves the time to the closest tick, earlier or later, that belongs to the slot of the url.
+def align_to_slot(url, moment):
+    slot = zlib.crc32(url.encode('utf-8')) % MONITOR_SLOTS
+    tick = round(moment / MONITOR_TICK)
+    offset = (slot - tick) % MONITOR_SLOTS
+    if offset > MONITOR_SLOTS / 2:
+        offset -= MONITOR_SLOTS
+    return (tick + offset) * MONITOR_TICK
+
+
+def schedule_url(url, next_check, interval):
+    next_check = align_to_slot(url, next_check)
+
+    with poll_schedule_lock:
+        poll_next_check[url] = next_check
+        poll_intervals[url] = interval
+        heapq.heappush(poll_schedule, (next_check, url))
+
+
+# Schedules a newly followed url, unless it is already monitored for someone else.
+def schedule_new_url(url):
+    with poll_schedule_lock:
+        if url in poll_intervals:
+            return
+
+    schedule_url(url, time.time() + POLL_MIN_INTERVAL, POLL_MIN_INTERVAL)
+
+
+def unschedule_url(url):
+    with poll_schedule_lock:
+        poll_next_check.pop(url, None)
+        poll_intervals.pop(url, None)
+
+
+# Removes and returns the urls that are due for a check, at most limit of them,
+# as a dict url -> the slot tick it was due on.
+def pop_due_urls(now, limit):
+    due = {}
+
+    with poll_schedule_lock:
+        while poll_schedule and poll_schedule[0][0] <= now and len(due) < limit:
+            next_check, url = heapq.heappop(poll_schedule)
+            if poll_next_check.get(url) == next_check:
+                del poll_next_check[url]
+                due[url] = next_check
+
+    return due
+
+
+def next_poll_interval(interval, changed):
+    if changed:
+        return max(POLL_MIN_INTERVAL, int(interval / 2))
+    return min(POLL_MAX_INTERVAL, int(interval * POLL_BACKOFF))
+
+
+# Seconds until a url that failed the given number of times in a row is tried again.
+def failure_retry_delay(failures):
+    return min(POLL_MAX_INTERVAL, POLL_MIN_INTERVAL * 2 ** min(failures, 32))
+
+
+# Replaces the subscription index with the subscriptions stored in the database and makes
+# the schedule match them: urls that are not scheduled yet get their stored schedule,
+# urls that nobody follows anymore are dropped. Returns the number of newly scheduled urls
+# that were already due.
+def load_subscriptions():
+    global subscribers, followed_urls, url_states, similarity_thresholds, similarity_baselines, subscriptions_loaded_at
+
+    new_subscribers = {}
+    new_followed_urls = {}
+    new_url_states = {}
+    new_similarity_thresholds = {}
+    new_similarity_baselines = {}
+    schedules = {}
+
+    # Handlers that commit while the index is loading wait for it, so their changes are
+    # either in the loaded data or applied on top of it
+    with subscriptions_lock:
+        data = storage.load_subscriptions()
+
+        for (url_id, url, hash_code, simhash, etag, last_modified, status, failures, interval, next_check,
+             chat_id, similarity, baseline) in data:
+            new_subscribers.setdefault(url, set()).add(chat_id)
+            new_followed_urls.setdefault(chat_id, {})[url] = None
+            new_url_states[url] = UrlState(url_id, hash_code, simhash, etag, last_modified, status, failures)
+            schedules[url] = (interval, next_check)
+            if similarity is not None:
+                new_similarity_thresholds.setdefault(url, {})[chat_id] = similarity
+                new_similarity_baselines.setdefault(url, {})[chat_id] = baseline
+
+        drift = sum(len(chat_ids ^ new_subscribers.get(url, set())) for url, chat_ids in subscribers.items())
+        drift += sum(len(chat_ids) for url, chat_ids in new_subscribers.items() if url not in subscribers)
+
+        subscribers = new_subscribers
+        followed_urls = new_followed_urls
+        url_states = new_url_states
+        similarity_thresholds = new_similarity_thresholds
+        similarity_baselines = new_similarity_baselines
+
+    now = time.time()
+    with poll_schedule_lock:
+        missing = [url for url in schedules if url not in poll_intervals]
+        dropped = [url for url in poll_intervals if url not in schedules]
+
+    overdue = 0
+    for url in missing:
+        interval, next_check = schedules[url]
+        interval = interval or POLL_MIN_INTERVAL
+
+        # On startup this is every url that came due while the bot was down
+        if next_check is None or next_check < now:
+            next_check = now + random.uniform(0, min(interval, STARTUP_JITTER))
+            overdue += 1
+
+        schedule_url(url, next_check, interval)
+
+    for url in dropped:
+        unschedule_url(url)
+
+    subscriptions_loaded_at = now
+    print_log("Subscriptions loaded, urls: %d, subscriptions changed outside of the bot: %d, "
+              "newly scheduled urls: %d, overdue: " % (len(new_url_states), drift, len(missing)), overdue)
+    return overdue
+
+
+def reload_subscriptions():
+    try:
+        return load_subscriptions()
+    except StorageError as e:
+        log_storage_error("Failed to load the subscriptions.", e)
+        return 0
+
+
+# Adds committed subscriptions of a chat to the index; states is a list of (url, UrlState).
+def add_subscriptions(chat_id, states):
+    with subscriptions_lock:
+        for url, state in states:
+            subscribers.setdefault(url, set()).add(chat_id)
+            followed_urls.setdefault(chat_id, {})[url] = None
+            url_states.setdefault(url, state)
+
+
+# Removes committed subscriptions of a chat from the index, all of them if urls is None.
+# Urls that nobody follows anymore are dropped from the schedule.
+def remove_subscriptions(chat_id, urls=None):
+    orphans = []
+
+    with subscriptions_lock:
+        chat_urls = followed_urls.get(chat_id, {})
+        for url in list(chat_urls) if urls is None else urls:
+            chat_urls.pop(url, None)
+            chat_ids = subscribers.get(url)
+            if chat_ids is None:
+                continue
+
+            chat_ids.discard(chat_id)
+            similarity_thresholds.get(url, {}).pop(chat_id, None)
+            similarity_baselines.get(url, {}).pop(chat_id, None)
+            if not chat_ids:
+                del subscribers[url]
+                url_states.pop(url, None)
+                similarity_thresholds.pop(url, None)
+                similarity_baselines.pop(url, None)
+                orphans.append(url)
+
+        if not chat_urls:
+            followed_urls.pop(chat_id, None)
+
+    for url in orphans:
+        unschedule_url(url)
+
+
+# Returns the UrlState of a followed url, a dict of the chat ids following it with their similarity
+# thresholds and a dict of the chat ids with a threshold and their baseline SimHashes,
+# or None if nobody follows it.
+def get_subscribers(url):
+    with subscriptions_lock:
+        if url not in subscribers:
+            return None
+        thresholds = similarity_thresholds.get(url, {})
+        return url_states[url], dict((chat_id, thresholds.get(chat_id)) for chat_id in subscribers[url]), \
+            dict(similarity_baselines.get(url, {}))
+
+
+# Sets the similarity threshold of a committed subscription, None for every change;
+# the current version of the page becomes the one later versions are compared with.
+def set_similarity_threshold(chat_id, url, similarity):
+    with subscriptions_lock:
+        if url not in subscribers:
+            return
+        if similarity is None:
+            similarity_thresholds.get(url, {}).pop(chat_id, None)
+            similarity_baselines.get(url, {}).pop(chat_id, None)
+        else:
+            similarity_thresholds.setdefault(url, {})[chat_id] = similarity
+            similarity_baselines.setdefault(url, {})[chat_id] = url_states[url].simhash
+
+
+def is_following(chat_id, url):
+    with subscriptions_lock:
+        return url in followed_urls.get(chat_id, {})
+
+
+# Returns up to limit urls a chat follows, in the order of their url ids and starting after after_id,
+# as (url_id, url, status, similarity threshold) rows.
+def get_followed_urls(chat_id, after_id=0, limit=LIST_PAGE_SIZE):
+    with subscriptions_lock:
+        data = [(url_states[url].url_id, url) for url in followed_urls.get(chat_id, {})]
+        data = heapq.nsmallest(limit, [row for row in data if row[0] > after_id])
+        return [(url_id, url, url_states[url].status, similarity_thresholds.get(url, {}).get(chat_id))
+                for url_id, url in data]
+
+
+# Stores the states of checked urls after they were committed; states maps url -> UrlState,
+# baselines are (url_id, chat_id, simhash) rows of the versions reported to chats with a threshold.
+def update_url_states(states, baselines=()):
+    with subscriptions_lock:
+        for url, state in states.items():
+            # The url might have been unfollowed and followed again meanwhile
+            if url in url_states and url_states[url].url_id == state.url_id:
+                url_states[url] = state
+
+        urls = dict((state.url_id, url) for url, state in states.items())
+        for url_id, chat_id, simhash in baselines:
+            url = urls[url_id]
+            if url in url_states and url_states[url].url_id == url_id and chat_id in similarity_baselines.get(url, {}):
+                similarity_baselines[url][chat_id] = simhash
 
 
 def is_url_valid_length(url):
@@ -58,6 +937,168 @@ def is_url_valid_length(url):
         return False
 
 
+# Hands out tokens at a steady rate, with bursts of up to capacity tokens.
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    # Blocks until a token is available and takes it.
+    def take(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+
+            time.sleep((1 - self.tokens) / self.rate)
+
+
+# Joins the texts into as few messages as possible, each within Telegram's message limit.
+def split_message(texts, separator="\n\n", limit=TELEGRAM_MESSAGE_LIMIT):
+    messages = []
+    current = ""
+
+    for text in texts:
+        while len(text) > limit:
+            if current:
+                messages.append(current)
+                current = ""
+            messages.append(text[:limit])
+            text = text[limit:]
+
+        if current and len(current) + len(separator) + len(text) > limit:
+            messages.append(current)
+            current = ""
+
+        current = current + separator + text if current else text
+
+    if current:
+        messages.append(current)
+
+    return messages
+
+
+# Queues a notification for delivery; never blocks on Telegram.
+def notify(chat_id, text):
+    notification_queue.put((chat_id, text))
+
+
+# Sends the coalesced notifications of one chat. Returns the texts that
+# should be retried later, or an empty list.
+def deliver_to_chat(bot, bucket, chat_id, texts):
+    messages = split_message(texts)
+
+    for number, message in enumerate(messages):
+        bucket.take()
+        try:
+            with NOTIFICATION_SEND_SECONDS.time():
+                bot.send_message(chat_id=chat_id, text=message)
+
+        except RetryAfter as e:
+            # Flood control applies to the whole bot, so everything waits
+            print_log("Flood control exceeded, waiting seconds: ", e.retry_after)
+            time.sleep(e.retry_after)
+            return messages[number:]
+
+        # A subclass of NetworkError, but permanent: e.g. the chat does not exist
+        except BadRequest as e:
+            print_log("Failed to deliver a notification to %s: " % str(chat_id), e.message)
+            return []
+
+        except NetworkError as e:
+            print_log("Failed to deliver a notification to %s, will retry: " % str(chat_id), e.message)
+            return messages[number:]
+
+        except TelegramError as e:
+            # E.g. the user blocked the bot; retrying will not help
+            print_log("Failed to deliver a notification to %s: " % str(chat_id), e.message)
+            return []
+
+    return []
+
+
+# Delivery worker: collects queued notifications per chat and sends them once
+# the coalescing window of the chat has passed, respecting the rate limits.
+# Once notification_stop is set, it sends everything without waiting and stops.
+def deliver_notifications(bot):
+    bucket = TokenBucket(NOTIFY_RATE, NOTIFY_RATE)
+    pending = {}
+    attempts = {}
+    chat_ready_at = {}
+
+    while True:
+        draining = notification_stop.is_set()
+        if draining and not pending and notification_queue.empty():
+            return
+
+        # The wait has a floor, a window of 0 would turn the loop into a busy one
+        try:
+            chat_id, text = notification_queue.get(timeout=min(1.0, max(0.05, NOTIFY_COALESCE_WINDOW)))
+            while True:
+                pending.setdefault(chat_id, (time.monotonic(), []))[1].append(text)
+                chat_id, text = notification_queue.get_nowait()
+        except queue.Empty:
+            pass
+
+        now = time.monotonic()
+        for chat_id in list(pending):
+            queued_at, texts = pending[chat_id]
+            if not draining and (queued_at + NOTIFY_COALESCE_WINDOW > now or chat_ready_at.get(chat_id, 0) > now):
+                continue
+
+            del pending[chat_id]
+            retry = deliver_to_chat(bot, bucket, chat_id, texts)
+            chat_ready_at[chat_id] = time.monotonic() + NOTIFY_CHAT_INTERVAL
+
+            if retry and attempts.get(chat_id, 0) < NOTIFY_MAX_RETRIES:
+                attempts[chat_id] = attempts.get(chat_id, 0) + 1
+                pending[chat_id] = (0, retry)
+            else:
+                if retry:
+                    print_log("Giving up on notifications for chat: ", chat_id)
+                attempts.pop(chat_id, None)
+
+        NOTIFICATIONS_PENDING.set(sum(len(texts) for _, texts in pending.values()))
+
+        # Forget chats that have been quiet for a while
+        for chat_id in [chat_id for chat_id, ready_at in chat_ready_at.items() if ready_at < now]:
+            del chat_ready_at[chat_id]
+
+
+def start_notification_worker(bot):
+    worker = threading.Thread(target=deliver_notifications, args=(bot,), name='notifications', daemon=True)
+    worker.start()
+    notification_workers.append(worker)
+
+
+# Sends the queued notifications on shutdown, waiting at most NOTIFY_DRAIN_TIMEOUT seconds;
+# their changes are committed already and would not be noticed again.
+def stop_notification_workers():
+    notification_stop.set()
+
+    deadline = time.monotonic() + NOTIFY_DRAIN_TIMEOUT
+    for worker in notification_workers:
+        worker.join(max(0.0, deadline - time.monotonic()))
+
+    if any(worker.is_alive() for worker in notification_workers):
+        print_log("Shutting down with undelivered notifications, queued: ", notification_queue.qsize())
+
+
+# Creates the tables the bot needs, if they do not exist already.
+def init_database():
+    try:
+        storage.init_schema()
+        print_log("Database schema is ready.")
+    except StorageError as e:
+        log_storage_error("Failed to create the database schema.", e)
+
+
 def start(update, context):
     current_chat_id = update.effective_chat.id
 
@@ -72,6 +1113,8 @@ def start(update, context):
             "/unfollow <link(s)> - Url(s) that you no longer want to keep track of\n" \
             "/unfollow_all - Delete all your urls from database\n" \
             "/list - Info on what you follow\n" \
+            "/similarity <link> <percent> - Ignore changes that leave the page at least that similar, " \
+            "100 reports every change\n" \
             "/help - Bot manual\n" \
             "/comment <comment> - Leave a comment for me! For safety reasons, max 30 comments per user is permitted\n" \
             "/list_comments - See all your comments\n" \
@@ -82,63 +1125,30 @@ def start(update, context):
 
 def end(update, context):
     current_chat_id = update.effective_chat.id
-    cursor = None
-    conn = None
 
-    # DB connection
     try:
-        conn = pscg.connect(DATABASE_URL, sslmode='require')
-        print_log("Successfully connected to database!")
+        storage.remove_subscriptions(current_chat_id)
+        remove_subscriptions(current_chat_id)
+        context.bot.send_message(chat_id=update.effective_chat.id, text="Url data wiped.")
 
-        cursor = conn.cursor()
-        delete_query1 = "delete from public.user_data where chat_id = %s"
-        delete_query2 = "delete from public.user_comments where chat_id = %s"
+    except StorageError as e:
+        context.bot.send_message(chat_id=update.effective_chat.id, text="Database issues. Failed to "
+                                                                        "wipe url data.")
+        log_storage_error("Failed to wipe url data.", e, current_chat_id)
 
-        try:
-            cursor.execute(delete_query1, [current_chat_id])
-            conn.commit()
-            context.bot.send_message(chat_id=update.effective_chat.id, text="Url data wiped.")
-
-        except pscg.Error as e:
-            context.bot.send_message(chat_id=update.effective_chat.id, text="Database issues. Failed to "
-                                                                            "wipe url data.")
-            print()
-            print_log(e.pgcode, ": Failed to execute query.")
-            print_log("Query in question: ", delete_query1)
-            print_log("Chat_id: ", current_chat_id)
-            print_log("Fail message: ", e.pgerror)
-            print()
+    try:
+        storage.remove_comments(current_chat_id)
+        context.bot.send_message(chat_id=update.effective_chat.id, text="Comments data wiped.")
 
-        try:
-            cursor.execute(delete_query2, [current_chat_id])
-            conn.commit()
-            context.bot.send_message(chat_id=update.effective_chat.id, text="Comments data wiped.")
-
-        except pscg.Error as e:
-            context.bot.send_message(chat_id=update.effective_chat.id, text="Database issues. Failed to "
-                                                                            "wipe comments data.")
-            print()
-            print_log(e.pgcode, ": Failed to execute query.")
-            print_log("Query in question: ", delete_query2)
-            print_log("Chat_id: ", current_chat_id)
-            print_log("Fail message: ", e.pgerror)
-            print()
-
-
-    except pscg.Error as e:
-        context.bot.send_message(chat_id=update.effective_chat.id, text="Database issues. Failed to connect...:\n")
-        print_log("Failed to connect to PostgreSQL database: ", e.pgcode)
-        print_log("Fail message: ", e.pgerror)
-    finally:
-        if conn:
-            cursor.close()
-            conn.close()
-            print_log("PostgreSQL connection is closed.")
+    except StorageError as e:
+        context.bot.send_message(chat_id=update.effective_chat.id, text="Database issues. Failed to "
+                                                                        "wipe comments data.")
+        log_storage_error("Failed to wipe comments data.", e, current_chat_id)
 
 
 def follow(update, context):
     current_chat_id = update.effective_chat.id
-    print_log("Follow command invoked for chat_id: ", str(current_chat_id))
+    print_log("Follow command invoked for chat_id: ", str(current_chat_id), level=LOG_DEBUG)
 
     # There should be at least 1 url sent together with command
     if len(context.args) < 1:
@@ -146,84 +1156,85 @@ def follow(update, context):
                                                                         "at least 1 argument.")
         return
 
-    urls = context.args
-    conn = None
-    cursor = None
-
+    # Duplicates are dropped, keeping the order
+    urls = list(dict.fromkeys(context.args))
+    followed = []
+    existing = []
+    not_valid = []
+    too_long = []
+    not_saved = []
+    not_supported = {}
+
+    # The cheap checks first: the length (1500 is upper max defined in database)
+    # and whether the chat follows the url already
+    candidates = []
     for url in urls:
-        # Check if url is in valid format and if it exists
-        if not is_url_valid(url):
-            context.bot.send_message(chat_id=update.effective_chat.id, text="Url not valid:\n" + url + "\n")
-            continue
-
-        # Check the length of url (1500 is upper max defined in database)
         if not is_url_valid_length(url):
-            context.bot.send_message(chat_id=update.effective_chat.id, text="Url must be less than 1500 characters:\n"
-                                                                            + url + "\n")
-            continue
-
-        # DB connection
+            too_long.append(url)
+        elif is_following(current_chat_id, url):
+            existing.append(url)
+        else:
+            candidates.append(url)
+
+    # Check that the urls exist and can be monitored, downloading and hashing all of them at once
+    results = fetch_urls(dict((url, (None, None)) for url in candidates), follow_fetch_executor, cache=True)
+    rows = []
+    for url in candidates:
+        result = results[url]
+        if result is None:
+            not_valid.append(url)
+        elif result.status != STATUS_OK:
+            not_supported.setdefault(status_descriptions[result.status], []).append(url)
+        else:
+            rows.append((url, result.hash, simhash_text(result.text)))
+
+    # Add all urls at once, entries that already exist are left as they are
+    inserted = {}
+    if rows:
         try:
-            conn = pscg.connect(DATABASE_URL, sslmode='require')
-            print_log("Successfully connected to database!")
-
-            cursor = conn.cursor()
-
-            check_query = "select *  from public.user_data where chat_id = %s and url = %s"
-
-            # Check if the entry already exists
-            try:
-                cursor.execute(check_query, (current_chat_id, url))
-                conn.commit()
-
-                # Add if not
-                if cursor.fetchone() is None:
-                    insert_query = "insert into public.user_data (chat_id, url, hash) values (%s, %s, %s)"
-                    values = (current_chat_id, url, get_url_hash(url))
-
-                    try:
-                        cursor.execute(insert_query, values)
-                        conn.commit()
-                        context.bot.send_message(chat_id=update.effective_chat.id, text="Successfully followed:\n"
-                                                                                        + url)
-                        print_log(str(current_chat_id) + ": followed ", url)
-                    except pscg.Error as e:
-                        context.bot.send_message(chat_id=update.effective_chat.id, text="Database issues. Failed "
-                                                                                        "to make an entry for url:\n"
-                                                                                        + url)
-                        print()
-                        print_log(e.pgcode, ": Failed to execute query.")
-                        print_log("Query in question: ", insert_query)
-                        print_log("Chat_id: ", current_chat_id)
-                        print_log("Fail message: ", e.pgerror)
-                        print()
-
-                # Send a message if it does
+            inserted = storage.add_subscriptions(current_chat_id, rows)
+
+            inserted = dict((state[1], UrlState(state[0], *state[2:])) for state in inserted)
+            add_subscriptions(current_chat_id, inserted.items())
+
+            for url in [row[0] for row in rows]:
+                if url in inserted:
+                    schedule_new_url(url)
+                    followed.append(url)
+                    print_log(str(current_chat_id) + ": followed ", url)
+
+                # Followed meanwhile, e.g. by the same command sent twice
                 else:
-                    context.bot.send_message(chat_id=update.effective_chat.id, text="Entry already exists:\n"
-                                                                                    + url)
-                    print_log(str(current_chat_id) + ": entry already exists ", url)
-
-            except pscg.Error as e:
-                context.bot.send_message(chat_id=update.effective_chat.id, text="Database issues. Failed "
-                                                                                "to check if there's an entry:\n"
-                                                                                + url)
-                print()
-                print_log(e.pgcode, ": Failed to execute query.")
-                print_log("Query in question: ", check_query)
-                print_log("Chat_id: ", current_chat_id)
-                print_log("Fail message: ", e.pgerror)
-                print()
-
-        except pscg.Error as e:
-            context.bot.send_message(chat_id=update.effective_chat.id, text="Database issues. Failed to connect...:\n")
-            print_log("Failed to connect to PostgreSQL database: ", e.pgcode)
-            print_log("Fail message: ", e.pgerror)
-        finally:
-            if conn:
-                cursor.close()
-                conn.close()
-                print_log("PostgreSQL connection is closed.")
+                    existing.append(url)
+
+        except StorageError as e:
+            not_saved = [row[0] for row in rows]
+            log_storage_error("Failed to add subscriptions.", e, current_chat_id)
+
+    # The first snapshots of the pages whose stored hash is the one just downloaded, the monitor
+    # only stores snapshots of new versions and the first change would have nothing to compare with
+    texts = dict((state.url_id, results[url].text) for url, state in inserted.items()
+                 if state.hash == results[url].hash and results[url].text is not None)
+    if texts:
+        try:
+            save_snapshots(texts)
+        except StorageError as e:
+            log_storage_error("Failed to save the snapshots.", e, current_chat_id)
+
+    # One summary reply, split only if it does not fit into a message
+    sections = [("Successfully followed:", followed), ("Entry already exists:", existing),
+                ("Url not valid:", not_valid), ("Url must be less than 1500 characters:", too_long),
+                ("Database issues. Failed to make an entry for urls:", not_saved)]
+    sections += [("Url can not be followed, " + description + ":", section_urls)
+                 for description, section_urls in not_supported.items()]
+
+    lines = []
+    for title, section_urls in sections:
+        if section_urls:
+            lines.extend(([""] if lines else []) + [title] + section_urls)
+
+    for text in split_message(lines, separator="\n"):
+        context.bot.send_message(chat_id=update.effective_chat.id, text=text)
 
 
 def unfollow(update, context):
@@ -234,176 +1245,150 @@ def unfollow(update, context):
                                                                         'at least 1 argument.')
         return
 
-    urls = context.args
-    conn = None
-    cursor = None
-
-    for url in urls:
-        # Check if url is in valid format and if it exists
-        if not is_url_valid(url):
-            context.bot.send_message(chat_id=update.effective_chat.id, text="Url not valid:\n" + url + "\n")
-            continue
+    urls = []
 
+    for url in context.args:
+        # No need to check if the url exists, the database lookup decides
         # Check the length of url (1500 is upper max defined in database)
         if not is_url_valid_length(url):
             context.bot.send_message(chat_id=update.effective_chat.id, text="Url must be less than 1500 characters:\n"
                                                                             + url + "\n")
             continue
 
-        # DB connection
-        try:
-            conn = pscg.connect(DATABASE_URL, sslmode='require')
-            print_log("Successfully connected to database!")
-
-            cursor = conn.cursor()
-
-            check_query = "select *  from public.user_data where chat_id = %s and url = %s"
-
-            # Check if the entry already exists
-            try:
-                cursor.execute(check_query, (current_chat_id, url))
-                conn.commit()
-
-                # Delete if yes
-                if cursor.fetchone() is not None:
-                    delete_query = "delete from public.user_data where chat_id = %s and url = %s"
-                    values = (current_chat_id, url)
-
-                    try:
-                        cursor.execute(delete_query, values)
-                        conn.commit()
-                        context.bot.send_message(chat_id=update.effective_chat.id, text="Successfully unfollowed:\n"
-                                                                                        + url)
-                        print_log(str(current_chat_id) + ": unfollowed ", url)
-                    except pscg.Error as e:
-                        context.bot.send_message(chat_id=update.effective_chat.id, text="Database issues. Failed "
-                                                                                        "to delete an entry for url:\n"
-                                                                                        + url)
-                        print()
-                        print_log(e.pgcode, ": Failed to execute query.")
-                        print_log("Query in question: ", delete_query)
-                        print_log("Chat_id: ", current_chat_id)
-                        print_log("Fail message: ", e.pgerror)
-                        print()
-
-                # Send a message if it does not
-                else:
-                    context.bot.send_message(chat_id=update.effective_chat.id, text="Entry does not exist:\n"
-                                                                                    + url)
-                    print_log(str(current_chat_id) + ": entry does not exist ", url)
-
-            except pscg.Error as e:
-                context.bot.send_message(chat_id=update.effective_chat.id, text="Database issues. Failed "
-                                                                                "to check if there's an entry:\n"
-                                                                                + url)
-                print()
-                print_log(e.pgcode, ": Failed to execute query.")
-                print_log("Query in question: ", check_query)
-                print_log("Chat_id: ", current_chat_id)
-                print_log("Fail message: ", e.pgerror)
-                print()
-
-        except pscg.Error as e:
-            context.bot.send_message(chat_id=update.effective_chat.id, text="Database issues. Failed to connect...:\n")
-            print_log("Failed to connect to PostgreSQL database: ", e.pgcode)
-            print_log("Fail message: ", e.pgerror)
-        finally:
-            if conn:
-                cursor.close()
-                conn.close()
-                print_log("PostgreSQL connection is closed.")
+        urls.append(url)
+
+    if not urls:
+        return
+
+    # Delete all urls at once and report the ones that did not exist
+    try:
+        deleted = set(storage.remove_subscriptions(current_chat_id, urls))
+
+    except StorageError as e:
+        context.bot.send_message(chat_id=update.effective_chat.id, text="Database issues. Failed "
+                                                                        "to delete entries for urls:\n"
+                                                                        + "\n".join(urls))
+        log_storage_error("Failed to remove subscriptions.", e, current_chat_id)
+        return
+
+    remove_subscriptions(current_chat_id, deleted)
+
+    for url in urls:
+        if url in deleted:
+            deleted.discard(url)
+            context.bot.send_message(chat_id=update.effective_chat.id, text="Successfully unfollowed:\n" + url)
+            print_log(str(current_chat_id) + ": unfollowed ", url)
+
+        # Send a message if it does not exist
+        else:
+            context.bot.send_message(chat_id=update.effective_chat.id, text="Entry does not exist:\n" + url)
+            print_log(str(current_chat_id) + ": entry does not exist ", url)
 
 
 def unfollow_all(update, context):
     current_chat_id = update.effective_chat.id
 
-    conn = None
-    cursor = None
-
-    # DB connection
     try:
-        conn = pscg.connect(DATABASE_URL, sslmode='require')
-        print_log("Successfully connected to database!")
+        storage.remove_subscriptions(current_chat_id)
+        remove_subscriptions(current_chat_id)
+        context.bot.send_message(chat_id=update.effective_chat.id, text="Your list of urls is now empty.")
 
-        cursor = conn.cursor()
+    except StorageError as e:
+        context.bot.send_message(chat_id=update.effective_chat.id, text="Database issues. Failed to "
+                                                                        "delete your data.")
+        log_storage_error("Failed to remove subscriptions.", e, current_chat_id)
 
-        delete_query = "delete from public.user_data where chat_id = %s"
 
-        try:
-            cursor.execute(delete_query, [current_chat_id])
-            conn.commit()
-            context.bot.send_message(chat_id=update.effective_chat.id, text="Your list of urls is now empty.")
-
-        except pscg.Error as e:
-            context.bot.send_message(chat_id=update.effective_chat.id, text="Database issues. Failed to "
-                                                                            "delete your data.")
-            print()
-            print_log(e.pgcode, ": Failed to execute query.")
-            print_log("Query in question: ", delete_query)
-            print_log("Chat_id: ", current_chat_id)
-            print_log("Fail message: ", e.pgerror)
-            print()
-
-    except pscg.Error as e:
-        context.bot.send_message(chat_id=update.effective_chat.id, text="Database issues. Failed to connect...:\n")
-        print_log("Failed to connect to PostgreSQL database: ", e.pgcode)
-        print_log("Fail message: ", e.pgerror)
-    finally:
-        if conn:
-            cursor.close()
-            conn.close()
-            print_log("PostgreSQL connection is closed.")
+# Sends the texts of a page in as few messages as possible. If there is a next page, the last message
+# gets a button for it, whose callback data is next_page, e.g. "list:<url id of the last url shown>".
+def send_page(bot, chat_id, texts, next_page=None, separator="\n"):
+    messages = split_message(texts, separator=separator)
+
+    for number, text in enumerate(messages):
+        reply_markup = None
+        if next_page is not None and number == len(messages) - 1:
+            reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("Next page", callback_data=next_page)]])
+
+        bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup)
+
+
+# Served from the subscription index, without touching the database.
+def send_urls_page(bot, chat_id, after_id=0):
+    # One more than a page tells whether there is a next page
+    data = get_followed_urls(chat_id, after_id, LIST_PAGE_SIZE + 1)
+
+    if not data:
+        bot.send_message(chat_id=chat_id, text="Currently you do not follow anything." if not after_id
+                                               else "There are no more urls.")
+        return
+
+    lines = [] if after_id else ["Urls you follow:"]
+    for url_id, url, status, similarity in data[:LIST_PAGE_SIZE]:
+        lines.append("- " + url)
+        if status in status_descriptions:
+            lines.append("  (" + status_descriptions[status] + ")")
+        if similarity is not None:
+            lines.append("  (changes reported below %g%% similarity)" % (similarity * 100))
+
+    next_page = None
+    if len(data) > LIST_PAGE_SIZE:
+        next_page = "list:%d" % data[LIST_PAGE_SIZE - 1][0]
+
+    send_page(bot, chat_id, lines, next_page)
 
 
 def list_all(update, context):
+    send_urls_page(context.bot, update.effective_chat.id)
+
+
+# Changes that leave the page at least the given percent similar are not reported to the chat.
+def similarity(update, context):
     current_chat_id = update.effective_chat.id
-    cursor = None
-    conn = None
 
-    # DB connection
+    if len(context.args) != 2:
+        context.bot.send_message(chat_id=update.effective_chat.id, text="That command requires 2 arguments, "
+                                                                        "an url you follow and a similarity "
+                                                                        "in percent, e.g.:\n/similarity "
+                                                                        "https://example.com 90")
+        return
+
+    url, percent = context.args
     try:
-        conn = pscg.connect(DATABASE_URL, sslmode='require')
-        print_log("Successfully connected to database!")
+        percent = float(percent.rstrip('%'))
+    except ValueError:
+        percent = None
+
+    # At 0% even a completely different page would not be reported
+    if percent is None or not 0 < percent <= 100:
+        context.bot.send_message(chat_id=update.effective_chat.id, text="Similarity must be a number "
+                                                                        "above 0 and at most 100.")
+        return
 
-        # Selecting all urls from current users and reporting
-        cursor = conn.cursor()
-        lookup_query = "select url from public.user_data where chat_id = %s"
+    # 100% is the default, every change is reported
+    threshold = None if percent == 100 else percent / 100
 
-        try:
-            cursor.execute(lookup_query, [current_chat_id])
-            data = cursor.fetchall()
+    try:
+        updated = storage.set_similarity(current_chat_id, url, threshold)
 
-            if data:
-                text = "Urls you follow:\n"
+    except StorageError as e:
+        context.bot.send_message(chat_id=update.effective_chat.id, text="Database issues. Failed to "
+                                                                        "change the similarity for url:\n" + url)
+        log_storage_error("Failed to set the similarity.", e, current_chat_id)
+        return
 
-                for url in data:
-                    url_txt = str(url[0])
-                    text = text + "- " + url_txt + "\n"
+    if not updated:
+        context.bot.send_message(chat_id=update.effective_chat.id, text="Entry does not exist:\n" + url)
+        return
 
-                context.bot.send_message(chat_id=update.effective_chat.id, text=text)
-            else:
-                context.bot.send_message(chat_id=update.effective_chat.id, text="Currently you do not follow "
-                                                                                "anything.")
-
-        except pscg.Error as e:
-            context.bot.send_message(chat_id=update.effective_chat.id, text="Database issues. Failed to "
-                                                                            "list your data.")
-            print()
-            print_log(e.pgcode, ": Failed to execute query.")
-            print_log("Query in question: ", lookup_query)
-            print_log("Chat_id: ", current_chat_id)
-            print_log("Fail message: ", e.pgerror)
-            print()
-
-    except pscg.Error as e:
-        context.bot.send_message(chat_id=update.effective_chat.id, text="Database issues. Failed to connect...:\n")
-        print_log("Failed to connect to PostgreSQL database: ", e.pgcode)
-        print_log("Fail message: ", e.pgerror)
-    finally:
-        if conn:
-            cursor.close()
-            conn.close()
-            print_log("PostgreSQL connection is closed.")
+    set_similarity_threshold(current_chat_id, url, threshold)
+    print_log(str(current_chat_id) + ": similarity set to %g%% for " % percent, url)
+
+    if threshold is None:
+        text = "You will be notified of every change of:\n" + url
+    else:
+        text = "You will be notified when the page is less than %g%% similar to the last " \
+               "reported version:\n" % percent + url
+    context.bot.send_message(chat_id=update.effective_chat.id, text=text)
 
 
 def show_help(update, context):
@@ -413,6 +1398,8 @@ def show_help(update, context):
            "/unfollow <link(s)> - Url(s) that you no longer want to keep track of\n" \
            "/unfollow_all - Delete all your urls from database\n" \
            "/list - Info on what you follow\n" \
+           "/similarity <link> <percent> - Ignore changes that leave the page at least that similar, " \
+           "100 reports every change\n" \
            "/help - Bot manual\n" \
            "/comment <comment> - Leave a comment for me! For safety reasons, max 30 comments per user is permitted\n" \
            "/list_comments - See all your comments\n" \
@@ -422,8 +1409,6 @@ def show_help(update, context):
 
 def comment(update, context):
     current_chat_id = update.effective_chat.id
-    conn = None
-    cursor = None
 
     # If text of comment is empty no point in sending anything
     if len(context.args) < 1:
@@ -436,151 +1421,75 @@ def comment(update, context):
     context.bot.send_message(chat_id=CREATOR_ID, text="New comment arrived:\n\n" + comment_text)
     context.bot.send_message(chat_id=update.effective_chat.id, text="Successfully sent a comment to the creator.")
 
-    # If user did not flood the database, make an entry for his comment,
-    # and if possible, update the name and username
+    # If user did not flood the database, make an entry for his comment, with the name and username
     try:
-        conn = pscg.connect(DATABASE_URL, sslmode='require')
-        print_log("Successfully connected to database!")
+        saved = storage.add_comment(current_chat_id, comment_text, update.effective_chat.username,
+                                    update.effective_chat.first_name, COMMENT_LIMIT)
+
+    except StorageError as e:
+        context.bot.send_message(chat_id=update.effective_chat.id, text="Database issues. Failed "
+                                                                        "to save a comment... "
+                                                                        "But the creator still got "
+                                                                        "it as a message, don't worry.\n")
+        log_storage_error("Failed to save a comment.", e, current_chat_id)
+        return
 
-        cursor = conn.cursor()
-        check_query = "select * from public.user_comments where chat_id = %s"
+    if saved:
+        print_log(str(current_chat_id) + ": User sent a comment.")
+    else:
+        context.bot.send_message(chat_id=update.effective_chat.id, text="You've sent too many comments "
+                                                                        "already... Comments are deleted "
+                                                                        "%d days after they were sent, "
+                                                                        "try again later." % (COMMENT_TTL // 86400))
+        print_log(str(current_chat_id) + ": user maximized number of comments.")
 
-        try:
-            cursor.execute(check_query, [current_chat_id])
-            conn.commit()
-            data = cursor.fetchall()
-
-            if len(data) < 30:
-                insert_query = "insert into public.user_comments (chat_id, comment_text) values (%s, %s)"
-                values = [current_chat_id, comment_text]
-
-                try:
-                    cursor.execute(insert_query, values)
-                    conn.commit()
-                    print_log(str(current_chat_id) + ": User sent a comment.")
-
-                    username_query = "update public.user_comments set username = %s " \
-                                     "where chat_id = %s and comment_text = %s"
-                    name_query = "update public.user_comments set first_name = %s " \
-                                 "where chat_id = %s and comment_text = %s"
-
-                    username = update.effective_chat.username
-                    name = update.effective_chat.first_name
-
-                    if username:
-                        try:
-                            cursor.execute(username_query, [username, current_chat_id, comment_text])
-                            conn.commit()
-                            print_log(str(current_chat_id) + ": Username updated.")
-                        except pscg.Error as e:
-                            print()
-                            print_log(e.pgcode, ": Failed to execute query.")
-                            print_log("Query in question: ", username_query)
-                            print_log("Chat_id: ", current_chat_id)
-                            print_log("Fail message: ", e.pgerror)
-                            print()
-
-                    if name:
-                        try:
-                            cursor.execute(name_query, [name, current_chat_id, comment_text])
-                            conn.commit()
-                            print_log(str(current_chat_id) + ": Name updated.")
-                        except pscg.Error as e:
-                            print()
-                            print_log(e.pgcode, ": Failed to execute query.")
-                            print_log("Query in question: ", name_query)
-                            print_log("Chat_id: ", current_chat_id)
-                            print_log("Fail message: ", e.pgerror)
-                            print()
-
-                except pscg.Error as e:
-                    context.bot.send_message(chat_id=update.effective_chat.id, text="Database issues. Failed "
-                                                                                    "to save a comment... "
-                                                                                    "But the creator still got "
-                                                                                    "it as a message, don't worry.\n")
-                    print()
-                    print_log(e.pgcode, ": Failed to execute query.")
-                    print_log("Query in question: ", insert_query)
-                    print_log("Chat_id: ", current_chat_id)
-                    print_log("Fail message: ", e.pgerror)
-                    print()
 
-            else:
-                context.bot.send_message(chat_id=update.effective_chat.id, text="You've sent too many comments "
-                                                                                "already... Wait for the "
-                                                                                "automatic cleanup, it might take a "
-                                                                                "few days.")
-                print_log(str(current_chat_id) + ": user maximized number of comments.")
-
-        except pscg.Error as e:
-            context.bot.send_message(chat_id=update.effective_chat.id, text="Database issues. Failed "
-                                                                            "to do a checkup...")
-            print()
-            print_log(e.pgcode, ": Failed to execute query.")
-            print_log("Query in question: ", check_query)
-            print_log("Chat_id: ", current_chat_id)
-            print_log("Fail message: ", e.pgerror)
-            print()
-
-    except pscg.Error as e:
-        context.bot.send_message(chat_id=update.effective_chat.id, text="Database issues. Failed to connect...:\n")
-        print_log("Failed to connect to PostgreSQL database: ", e.pgcode)
-        print_log("Fail message: ", e.pgerror)
-    finally:
-        if conn:
-            cursor.close()
-            conn.close()
-            print_log("PostgreSQL connection is closed.")
+def send_comments_page(bot, chat_id, after_id=0):
+    try:
+        data = storage.list_comments(chat_id, after_id, LIST_PAGE_SIZE + 1)
 
+    except StorageError as e:
+        bot.send_message(chat_id=chat_id, text="Database issues. Failed to list your data.")
+        log_storage_error("Failed to list comments.", e, chat_id)
+        return
 
-def list_comments(update, context):
-    current_chat_id = update.effective_chat.id
-    cursor = None
-    conn = None
+    if not data:
+        bot.send_message(chat_id=chat_id, text="You've got no comments." if not after_id
+                                               else "There are no more comments.")
+        return
 
-    # DB connection
-    try:
-        conn = pscg.connect(DATABASE_URL, sslmode='require')
-        print_log("Successfully connected to database!")
+    # Every comment is kept in one message, unless it is longer than a message
+    texts = [] if after_id else ["Your comments:\n\n-----"]
+    for comment_id, comment_text in data[:LIST_PAGE_SIZE]:
+        texts.append("Comment id: " + str(comment_id) + "\nComment text:\n" + str(comment_text) + "\n-----")
 
-        # Selecting all urls from current users and reporting
-        cursor = conn.cursor()
-        lookup_query = "select comment_id, comment_text from public.user_comments where chat_id = %s"
+    next_page = None
+    if len(data) > LIST_PAGE_SIZE:
+        next_page = "comments:%d" % data[LIST_PAGE_SIZE - 1][0]
 
-        try:
-            cursor.execute(lookup_query, [current_chat_id])
-            data = cursor.fetchall()
+    send_page(bot, chat_id, texts, next_page)
 
-            if data:
-                text = "Your comments:\n\n-----\n"
 
-                for comment_id, comment_text in data:
-                    text = text + "Comment id: " + str(comment_id) + "\n" +\
-                           "Comment text:\n" + str(comment_text) + "\n-----\n"
+def list_comments(update, context):
+    send_comments_page(context.bot, update.effective_chat.id)
 
-                context.bot.send_message(chat_id=update.effective_chat.id, text=text)
-            else:
-                context.bot.send_message(chat_id=update.effective_chat.id, text="You've got no comments.")
-
-        except pscg.Error as e:
-            context.bot.send_message(chat_id=update.effective_chat.id, text="Database issues. Failed to "
-                                                                            "list your data.")
-            print()
-            print_log(e.pgcode, ": Failed to execute query.")
-            print_log("Query in question: ", lookup_query)
-            print_log("Chat_id: ", current_chat_id)
-            print_log("Fail message: ", e.pgerror)
-            print()
-
-    except pscg.Error as e:
-        context.bot.send_message(chat_id=update.effective_chat.id, text="Database issues. Failed to connect...:\n")
-        print_log("Failed to connect to PostgreSQL database: ", e.pgcode)
-        print_log("Fail message: ", e.pgerror)
-    finally:
-        if conn:
-            cursor.close()
-            conn.close()
-            print_log("PostgreSQL connection is closed.")
+
+# Shows the next page of /list or /list_comments, from the button under the previous page.
+def next_page(update, context):
+    query = update.callback_query
+    query.answer()
+
+    # The button is used up; messages that are too old to be edited keep it
+    try:
+        query.edit_message_reply_markup(reply_markup=None)
+    except TelegramError:
+        pass
+
+    command, after_id = query.data.split(':')
+    if command == 'list':
+        send_urls_page(context.bot, update.effective_chat.id, int(after_id))
+    else:
+        send_comments_page(context.bot, update.effective_chat.id, int(after_id))
 
 
 def kraljevo(update, context):
@@ -590,8 +1499,6 @@ def kraljevo(update, context):
 
 def send_a_message_to_users(update, context):
     sender_chat_id = chat_id=update.effective_chat.id
-    cursor = None
-    conn = None
 
     if sender_chat_id != CREATOR_ID:
         context.bot.send_message(chat_id=update.effective_chat.id, text='You are not allowed to use that command. :)')
@@ -607,185 +1514,504 @@ def send_a_message_to_users(update, context):
     message_text = context.args.join(" ")
 
     try:
-        conn = pscg.connect(DATABASE_URL, sslmode='require')
-        print_log("Successfully connected to database!")
+        data = storage.subscribed_chat_ids()
+    except StorageError as e:
+        log_storage_error("Failed to look up the chats.", e)
+        return
 
-        # Selecting all chat ids from database
-        cursor = conn.cursor()
-        lookup_query = "select distinct chat_id from public.user_data"
+    for chat_id in data:
+        if chat_id != CREATOR_ID:
+            print_log("Sending a message to: ", chat_id)
+            context.bot.send_message(chat_id=chat_id, text=message_text)
+
+
+# Wraps a command handler so that its duration is recorded per command.
+def timed_command(command, callback):
+    def timed_callback(update, context):
+        with COMMAND_SECONDS.labels(command).time():
+            return callback(update, context)
+
+    return timed_callback
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        expected = ('Bearer ' + METRICS_TOKEN).encode()
+        if not hmac.compare_digest(self.request.headers.get('Authorization', '').encode(), expected):
+            self.set_header('WWW-Authenticate', 'Bearer')
+            self.send_error(401)
+            return
+        self.set_header('Content-Type', CONTENT_TYPE_LATEST)
+        self.write(generate_latest())
+
+
+# Serves /metrics from the webhook server, so that it is reachable on PORT. Without METRICS_TOKEN
+# the metrics are not served at all.
+def start_metrics_endpoint(webhook_server):
+    if not METRICS_TOKEN:
+        return
+    app = webhook_server.http_server.request_callback
+    webhook_server.loop.add_callback(app.add_handlers, r".*", [(r"/metrics", MetricsHandler)])
 
-        try:
-            cursor.execute(lookup_query)
-            conn.commit()
-            data = cursor.fetchall()
-
-            if data:
-                for chat_id in data:
-                    if chat_id != CREATOR_ID:
-                        print_log("Sending a message to: ", chat_id)
-                        context.bot.send_message(chat_id=chat_id, text=message_text)
-
-        except pscg.Error as e:
-            print()
-            print_log(e.pgcode, ": Failed to execute query.")
-            print_log("Query in question: ", lookup_query)
-            print_log("Chat_id: ", chat_id)
-            print_log("Fail message: ", e.pgerror)
-            print()
-
-    except pscg.Error as e:
-        print_log("Failed to connect to PostgreSQL database: ", e.pgcode)
-        print_log("Fail message: ", e.pgerror)
-    finally:
-        if conn:
-            cursor.close()
-            conn.close()
-            print_log("PostgreSQL connection is closed.")
+
+# Serves /metrics on METRICS_PORT from a thread of its own, for processes without the webhook server.
+# Without METRICS_TOKEN the metrics are not served at all.
+def start_metrics_server():
+    if not METRICS_TOKEN:
+        return
+
+    def serve():
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        tornado.web.Application([(r"/metrics", MetricsHandler)]).listen(METRICS_PORT)
+        tornado.ioloop.IOLoop.current().start()
+
+    threading.Thread(target=serve, name='metrics', daemon=True).start()
 
 
 def unknown(update, context):
     context.bot.send_message(chat_id=update.effective_chat.id, text="Unknown command!\n")
 
 
-def callback_minute(context: telegram.ext.CallbackContext):
-    cursor = None
-    conn = None
+def compress_text(text):
+    return zlib.compress(text.encode('utf-8'))
+
+
+def decompress_text(data):
+    return zlib.decompress(bytes(data)).decode('utf-8')
+
+
+# Few of the changed lines, for the notification. The added lines come first, a rewritten block
+# would otherwise fill the excerpt with what was removed; removed lines fill the rest.
+def diff_excerpt(old_lines, new_lines):
+    added = []
+    removed = []
+    for number, line in enumerate(difflib.unified_diff(old_lines, new_lines, n=0)):
+        # Skip the file headers and the hunk headers
+        if number < 2 or line.startswith('@@'):
+            continue
+
+        line = " ".join(line.split())
+        if len(line) <= 1:
+            continue
+
+        if len(line) > SNAPSHOT_EXCERPT_LINE_LENGTH:
+            line = line[:SNAPSHOT_EXCERPT_LINE_LENGTH] + "..."
+        (added if line.startswith('+') else removed).append(line)
+
+        if len(added) == SNAPSHOT_EXCERPT_LINES:
+            break
+
+    return "\n".join((added + removed)[:SNAPSHOT_EXCERPT_LINES])
+
+
+# Stores the new versions of the pages in place of the previous ones.
+# Takes a dict url_id -> text and returns a dict url_id -> excerpt of the changes.
+def save_snapshots(texts):
+    latest = storage.load_latest_snapshots(list(texts))
+
+    excerpts = {}
+    snapshots = []
+    for url_id, text in texts.items():
+        if url_id not in latest:
+            snapshots.append((url_id, 1, compress_text(text)))
+            continue
+
+        version, body = latest[url_id]
+        old_text = decompress_text(body)
+        if old_text == text:
+            continue
+
+        excerpts[url_id] = diff_excerpt(old_text.splitlines(True), text.splitlines(True))
+        snapshots.append((url_id, version + 1, compress_text(text)))
+
+    if snapshots:
+        storage.save_snapshots(snapshots)
+
+    return excerpts
+
 
+# Writes the url states, including the new hashes, of one monitor tick with one statement,
+# in a single transaction, releasing their leases, and notifies the followers afterwards.
+# Changes is a list of (url_id, url, chat ids) of the changed urls, baselines a list of
+# (url_id, chat_id, simhash) of the versions reported to chats with a similarity threshold,
+# notices a list of (url_id, chat ids, text) of other messages. With an owner only the urls still leased to it
+# are saved and notified of, another worker may have claimed the others after their leases
+# expired. Returns whether the states were saved.
+def save_monitor_results(state_rows, changes, baselines, texts, notices=(), owner=None):
     try:
-        conn = pscg.connect(DATABASE_URL, sslmode='require')
-        print_log("Successfully connected to database!")
+        saved = storage.save_url_states(state_rows, owner, baselines)
 
-        # Selecting all urls from current users and report if hash has changed
-        # since the last callback
-        cursor = conn.cursor()
-        lookup_query = "select chat_id, url, hash from public.user_data"
+    except StorageError as e:
+        log_storage_error("Failed to save the url states.", e)
+        return False
+
+    if len(saved) < len(state_rows):
+        MONITOR_LEASES_LOST.inc(len(state_rows) - len(saved))
+        print_log("Urls no longer leased, results dropped: ", len(state_rows) - len(saved))
+        texts = dict((url_id, text) for url_id, text in texts.items() if url_id in saved)
+        changes = [change for change in changes if change[0] in saved]
+        notices = [notice for notice in notices if notice[0] in saved]
 
+    # Snapshots are only a nicety, failing to store them must not stop the notifications
+    excerpts = {}
+    if texts:
         try:
-            cursor.execute(lookup_query)
-            conn.commit()
-            data = cursor.fetchall()
-
-            update_query = "update public.user_Data set hash = %s where chat_id = %s and url = %s"
-
-            if data:
-                for chat_id, url, hash_code in data:
-                    print_log("Monitoring url for chat: ", chat_id)
-                    print_log("url: ", url)
-
-                    hash_new = get_url_hash(url)
-                    if hash_code != hash_new:
-                        try:
-                            cursor.execute(update_query, [hash_new, chat_id, url])
-                            conn.commit()
-                            print_log("Change noted for user %s: " % str(chat_id), url)
-                            text = "The content of the following site has changed:\n" + url
-                            context.bot.send_message(chat_id=chat_id, text=text)
-                        except pscg.Error as e:
-                            print()
-                            print_log(e.pgcode, ": Failed to execute query.")
-                            print_log("Query in question: ", update_query)
-                            print_log("Chat_id: ", chat_id)
-                            print_log("Fail message: ", e.pgerror)
-                            print()
-
-        except pscg.Error as e:
-            print()
-            print_log(e.pgcode, ": Failed to execute query.")
-            print_log("Query in question: ", lookup_query)
-            print_log("Fail message: ", e.pgerror)
-            print()
-
-    except pscg.Error as e:
-        context.bot.send_message(chat_id=CREATOR_ID, text="Database issues. Failed to connect...:\n")
-        print_log("Failed to connect to PostgreSQL database: ", e.pgcode)
-        print_log("Fail message: ", e.pgerror)
+            excerpts = save_snapshots(texts)
+        except StorageError as e:
+            log_storage_error("Failed to save the snapshots.", e)
+
+    for url_id, url, chat_ids in changes:
+        MONITOR_CHANGES.inc(len(chat_ids))
+        text = "The content of the following site has changed:\n" + url
+        if excerpts.get(url_id):
+            text = text + "\n\nWhat changed:\n" + excerpts[url_id]
+
+        for chat_id in chat_ids:
+            print_log("Change noted for user %s: " % str(chat_id), url)
+            notify(chat_id, text)
+
+    for _, chat_ids, text in notices:
+        for chat_id in chat_ids:
+            notify(chat_id, text)
+
+    return True
+
+
+def callback_minute(context: telegram.ext.CallbackContext):
+    # A tick that outlived its interval must not be overlapped by the next one,
+    # otherwise both would check the same urls and notify twice
+    if not monitor_lock.acquire(blocking=False):
+        MONITOR_TICKS_SKIPPED.inc()
+        print_log("Previous monitor tick still running, tick skipped.")
+        return
+
+    try:
+        with MONITOR_TICK_SECONDS.time():
+            monitor_urls(context)
     finally:
-        if conn:
-            cursor.close()
-            conn.close()
-            print_log("PostgreSQL connection is closed.")
+        monitor_lock.release()
+
+
+# Which of the followers to notify of a change of the page: those who did not set a similarity threshold
+# and those whose threshold is above the similarity of the new version to the version last reported
+# to them. Chat_ids maps chat id -> similarity threshold, baselines chat id -> SimHash of that version.
+# Without SimHashes (e.g. large pages) every change is reported.
+def changed_for(chat_ids, baselines, simhash):
+    notify_chat_ids = []
+    for chat_id, threshold in chat_ids.items():
+        similarity = simhash_similarity(baselines.get(chat_id), simhash)
+        if threshold is None or similarity is None or similarity < threshold:
+            notify_chat_ids.append(chat_id)
+    return notify_chat_ids
+
+
+# Downloads the pages and works out their new states. Pages maps url -> (UrlState, {chat id: similarity
+# threshold}, {chat id: baseline SimHash}, interval).
+# Returns the rows for save_monitor_results, the new UrlStates, the changes, the new baselines, the notices,
+# the texts and the delay until the next check and the new check interval of every url.
+def check_pages(pages):
+    results = fetch_urls(dict((url, (state.etag, state.last_modified)) for url, (state, _, _, _) in pages.items()))
+
+    now = time.time()
+    state_rows = []
+    states = {}
+    changes = []
+    baseline_rows = []
+    notices = []
+    texts = {}
+    intervals = {}
+    for url, (state, chat_ids, baselines, interval) in pages.items():
+        print_log("Monitoring url for %d chat(s): " % len(chat_ids), url, level=LOG_DEBUG)
+
+        result = results[url]
+        MONITOR_URLS_CHECKED.labels(result.status if result else 'error').inc()
+
+        # A failed download keeps the hash, the validators and the interval; the url is retried
+        # with an exponential backoff, which a single bad site can not turn into a busy loop
+        if result is None:
+            failures = state.failures + 1
+            delay = failure_retry_delay(failures)
+            intervals[url] = (delay, interval)
+            state_rows.append((state.url_id, None, None, state.etag, state.last_modified, STATUS_UNREACHABLE,
+                               failures, interval, now + delay))
+            states[url] = state._replace(status=STATUS_UNREACHABLE, failures=failures)
+
+            if failures == UNREACHABLE_NOTICE_AFTER:
+                notices.append((state.url_id, chat_ids, "The following site is unreachable, I will keep trying "
+                                                        "and let you know when it is back:\n" + url))
+            continue
+
+        if UNREACHABLE_NOTICE_AFTER and state.failures >= UNREACHABLE_NOTICE_AFTER:
+            notices.append((state.url_id, chat_ids, "The following site is reachable again:\n" + url))
+
+        changed = result.status == STATUS_OK and state.hash != result.hash
+        simhash = simhash_text(result.text) if changed else None
+
+        # The first hash of a page, or the first of another kind of hash, is not a change
+        notify_chat_ids = []
+        suppressed = False
+        if changed and state.hash is not None and fingerprint_kind(state.hash) == fingerprint_kind(result.hash):
+            notify_chat_ids = changed_for(chat_ids, baselines, simhash)
+            baseline_rows.extend((state.url_id, chat_id, simhash) for chat_id in notify_chat_ids
+                                 if chat_id in baselines)
+
+            # A change too small for every follower does not speed up the polling; the new hashes
+            # are kept, the followers with a threshold keep comparing with the version last reported to them
+            if not notify_chat_ids:
+                MONITOR_CHANGES_SUPPRESSED.inc()
+                suppressed = True
+
+        interval = next_poll_interval(interval, changed and not suppressed)
+        intervals[url] = (interval, interval)
+
+        # Remember the hashes, the validators, so that the next check can be conditional,
+        # the status, so that users can see why a page is not monitored,
+        # and the schedule, so that it survives restarts
+        # Validators are only kept for monitored pages: a page that was too large or of the wrong
+        # content type must be downloaded again to see whether it still is, a 304 would hide it
+        etag, last_modified, status = result.etag, result.last_modified, result.status
+        if status in (STATUS_TOO_LARGE, STATUS_BAD_CONTENT_TYPE):
+            etag, last_modified = None, None
+        elif status == STATUS_NOT_MODIFIED and state.status in (STATUS_TOO_LARGE, STATUS_BAD_CONTENT_TYPE):
+            status = state.status
+
+        new_hash = result.hash if changed else None
+        state_rows.append((state.url_id, new_hash, simhash, etag, last_modified, status, 0,
+                           interval, now + interval))
+        states[url] = UrlState(state.url_id, new_hash or state.hash, simhash if changed else state.simhash,
+                               etag, last_modified, status, 0)
+
+        if result.status == STATUS_NOT_MODIFIED:
+            continue
 
+        if result.status != STATUS_OK:
+            print_log("Url not monitored (%s): " % result.status, url)
+            continue
+
+        # Snapshots are only stored for new versions, neither is the snapshot replaced for a suppressed
+        # change, so that the next excerpt shows everything since the last reported change
+        if changed and not suppressed and result.text is not None:
+            texts[state.url_id] = result.text
+
+        if notify_chat_ids:
+            changes.append((state.url_id, url, notify_chat_ids))
+
+    return state_rows, states, changes, baseline_rows, notices, texts, intervals
+
+
+def monitor_urls(context):
+    if time.time() - subscriptions_loaded_at > SUBSCRIPTIONS_RELOAD_INTERVAL:
+        reload_subscriptions()
+
+    due_urls = pop_due_urls(time.time(), MONITOR_MAX_BATCH)
+    if not due_urls:
+        return
+
+    # The followers and the last known state of the due urls come from the subscription index,
+    # every distinct url is downloaded and hashed only once per tick
+    pages = {}
+    for url in due_urls:
+        page = get_subscribers(url)
+
+        # Nobody follows it anymore
+        if page is None:
+            unschedule_url(url)
+            continue
+
+        state, chat_ids, baselines = page
+        pages[url] = (state, chat_ids, baselines, poll_intervals.get(url, POLL_MIN_INTERVAL))
+
+    # Changes of the whole tick are written in one transaction
+    state_rows, states, changes, baselines, notices, texts, intervals = check_pages(pages)
+
+    # The next check is counted from the slot tick the url was due on, not from the end of the check,
+    # which would always land just past the slot and wait for another turn of the wheel.
+    # Urls that were checked late (e.g. left over from a full batch) start over from now.
+    now = time.time()
+    for url, (delay, interval) in intervals.items():
+        next_check = due_urls[url] + delay
+        schedule_url(url, next_check if next_check >= now else now + delay, interval)
+
+    # Until the states are saved the index keeps the old hashes,
+    # so that unsaved changes are noticed again on the next check
+    if state_rows and save_monitor_results(state_rows, changes, baselines, texts, notices):
+        update_url_states(states, baselines)
 
-def callback_10_days(context: telegram.ext.CallbackContext):
-    cursor = None
-    conn = None
 
+# Claims up to MONITOR_MAX_BATCH due urls for this worker, checks them and saves the results,
+# which releases the leases. Returns the number of claimed urls.
+def monitor_claimed_urls(bot):
     try:
-        conn = pscg.connect(DATABASE_URL, sslmode='require')
-        print_log("Successfully connected to database!")
+        data = storage.claim_urls(WORKER_ID, MONITOR_LEASE, MONITOR_MAX_BATCH)
+    except StorageError as e:
+        log_storage_error("Failed to claim urls.", e)
+        return 0
+
+    # Urls unfollowed since the claim keep their lease until it expires, nobody claims them afterwards
+    pages = {}
+    for url_id, url, hash_code, simhash, etag, last_modified, status, failures, interval, subscriptions in data:
+        pages[url] = (UrlState(url_id, hash_code, simhash, etag, last_modified, status, failures),
+                      dict((chat_id, similarity) for chat_id, similarity, _ in subscriptions),
+                      dict((chat_id, baseline) for chat_id, similarity, baseline in subscriptions
+                           if similarity is not None),
+                      interval or POLL_MIN_INTERVAL)
+
+    # The leases are renewed until the results are saved, the save releases them
+    checked = threading.Event()
+    renewer = threading.Thread(target=renew_leases, args=([row[0] for row in data], checked),
+                               name='lease-renewer', daemon=True)
+    renewer.start()
+    try:
+        state_rows, states, changes, baselines, notices, texts, intervals = check_pages(pages)
+        if state_rows:
+            save_monitor_results(state_rows, changes, baselines, texts, notices, WORKER_ID)
+    finally:
+        checked.set()
+        renewer.join()
+
+    return len(data)
 
-        # Delete all comments
-        cursor = conn.cursor()
-        refresh_query = "delete from public.user_comments"
 
+# Renews the leases of the claimed urls every third of MONITOR_LEASE until checked is set.
+def renew_leases(url_ids, checked):
+    while not checked.wait(MONITOR_LEASE / 3):
         try:
-            cursor.execute(refresh_query)
-            conn.commit()
-            context.bot.send_message(chat_id=CREATOR_ID, text="I have refreshed the comments database.")
-            print_log("Comments database refreshed.")
-
-        except pscg.Error as e:
-            print()
-            context.bot.send_message(chat_id=CREATOR_ID, text="Failed to refresh the comments database...")
-            print_log(e.pgcode, ": Failed to execute query.")
-            print_log("Query in question: ", refresh_query)
-            print_log("Fail message: ", e.pgerror)
-            print()
-
-    except pscg.Error as e:
-        context.bot.send_message(chat_id=CREATOR_ID, text="Database issues. Failed to connect...:\n")
-        print_log("Failed to connect to PostgreSQL database: ", e.pgcode)
-        print_log("Fail message: ", e.pgerror)
+            storage.renew_leases(WORKER_ID, url_ids, MONITOR_LEASE)
+        except StorageError as e:
+            log_storage_error("Failed to renew the leases.", e)
+
+
+# Gives up the leases of this worker, so that its urls can be claimed right away.
+def release_leases():
+    try:
+        released = storage.release_leases(WORKER_ID)
+        print_log("Leases released: ", released)
+    except StorageError as e:
+        log_storage_error("Failed to release the leases.", e)
+
+
+# Monitor worker process: claims and checks due urls until it is stopped. A full batch means
+# more urls are due, so the next one is claimed right away; otherwise it waits for the next tick.
+# The leases are released when it is stopped (SIGTERM); those of a run that was killed expire.
+# The first claim waits a random part of a tick, so that workers restarted together by a deploy
+# do not claim in lockstep.
+def run_worker():
+    bot = telegram.Bot(token=os.environ['TOKEN'])
+    start_notification_worker(bot)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    start_metrics_server()
+
+    print_log("Monitor worker started in %.2f seconds: " % (time.monotonic() - process_started_at), WORKER_ID)
+
+    time.sleep(random.uniform(0, MONITOR_TICK))
+    try:
+        while True:
+            started = time.time()
+
+            with MONITOR_TICK_SECONDS.time():
+                claimed = monitor_claimed_urls(bot)
+
+            if claimed < MONITOR_MAX_BATCH:
+                time.sleep(max(0.0, MONITOR_TICK - (time.time() - started)))
     finally:
-        if conn:
-            cursor.close()
-            conn.close()
-            print_log("PostgreSQL connection is closed.")
-
-
-TOKEN = os.environ['TOKEN']
-PORT = int(os.environ.get('PORT', '8443'))
-
-updater = Updater(token=TOKEN, use_context=True)
-job_queuer = updater.job_queue
-
-updater.start_webhook(listen="0.0.0.0", port=PORT, url_path=TOKEN)
-updater.bot.setWebhook('https://avro-bot.herokuapp.com/' + TOKEN)
-
-dispatcher = updater.dispatcher
-
-# Uncomment this if you'd like integrated logging
-# logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
-
-start_handler = CommandHandler('start', start, run_async=True)
-follow_handler = CommandHandler('follow', follow, run_async=True)
-unfollow_handler = CommandHandler('unfollow', unfollow, run_async=True)
-unfollow_all_handler = CommandHandler('unfollow_all', unfollow_all, run_async=True)
-list_handler = CommandHandler('list', list_all)
-help_handler = CommandHandler('help', show_help)
-kraljevo_handler = CommandHandler('kraljevo', kraljevo)
-comment_handler = CommandHandler('comment', comment)
-list_comments_handler = CommandHandler('list_comments', list_comments)
-send_a_message_to_users_handler = CommandHandler('send_a_message_to_users', send_a_message_to_users)
-end_handler = CommandHandler('end', end, run_async=True)
-
-unknown_handler = MessageHandler(Filters.command, unknown)
-
-dispatcher.add_handler(kraljevo_handler)
-dispatcher.add_handler(start_handler)
-dispatcher.add_handler(follow_handler)
-dispatcher.add_handler(unfollow_handler)
-dispatcher.add_handler(unfollow_all_handler)
-dispatcher.add_handler(list_handler)
-dispatcher.add_handler(help_handler)
-dispatcher.add_handler(end_handler)
-dispatcher.add_handler(comment_handler)
-dispatcher.add_handler(list_comments_handler)
-dispatcher.add_handler(send_a_message_to_users_handler)
-dispatcher.add_handler(unknown_handler)
-
-job_queuer.run_repeating(callback_minute, interval=30, first=0)
-job_queuer.run_repeating(callback_10_days, interval=432000, first=432000)
-
-updater.start_polling()
-updater.idle()
\ No newline at end of file
+        release_leases()
+        stop_notification_workers()
+
+
+# Deletes the expired comments, a batch at a time until none are left.
+def callback_prune_comments(context: telegram.ext.CallbackContext):
+    pruned = 0
+    try:
+        while True:
+            deleted = storage.prune_comments(COMMENT_TTL, COMMENT_PRUNE_BATCH)
+
+            pruned += deleted
+            if deleted < COMMENT_PRUNE_BATCH:
+                break
+
+    except StorageError as e:
+        log_storage_error("Failed to delete the expired comments.", e)
+
+    if pruned:
+        print_log("Expired comments deleted: ", pruned)
+
+
+def main():
+    start_log_writer()
+    init_database()
+
+    if sys.argv[1:] == ['worker']:
+        run_worker()
+        return
+
+    overdue = reload_subscriptions()
+    STARTUP_OVERDUE_URLS.set(overdue)
+
+    TOKEN = os.environ['TOKEN']
+    PORT = int(os.environ.get('PORT', '8443'))
+
+    updater = Updater(token=TOKEN, use_context=True, workers=DISPATCHER_WORKERS)
+    job_queuer = updater.job_queue
+
+    updater.start_webhook(listen="0.0.0.0", port=PORT, url_path=TOKEN)
+    start_metrics_endpoint(updater.httpd)
+    updater.bot.setWebhook('https://avro-bot.herokuapp.com/' + TOKEN)
+
+    dispatcher = updater.dispatcher
+    start_notification_worker(updater.bot)
+
+    # Uncomment this if you'd like integrated logging
+    # logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    start_handler = CommandHandler('start', timed_command('start', start), run_async=True)
+    follow_handler = CommandHandler('follow', timed_command('follow', follow), run_async=True)
+    unfollow_handler = CommandHandler('unfollow', timed_command('unfollow', unfollow), run_async=True)
+    unfollow_all_handler = CommandHandler('unfollow_all', timed_command('unfollow_all', unfollow_all), run_async=True)
+    list_handler = CommandHandler('list', timed_command('list', list_all))
+    similarity_handler = CommandHandler('similarity', timed_command('similarity', similarity), run_async=True)
+    help_handler = CommandHandler('help', timed_command('help', show_help))
+    kraljevo_handler = CommandHandler('kraljevo', timed_command('kraljevo', kraljevo))
+    comment_handler = CommandHandler('comment', timed_command('comment', comment))
+    list_comments_handler = CommandHandler('list_comments', timed_command('list_comments', list_comments))
+    next_page_handler = CallbackQueryHandler(timed_command('next_page', next_page), pattern=r'^(list|comments):\d+$',
+                                             run_async=True)
+    send_a_message_to_users_handler = CommandHandler('send_a_message_to_users',
+                                                     timed_command('send_a_message_to_users', send_a_message_to_users))
+    end_handler = CommandHandler('end', timed_command('end', end), run_async=True)
+
+    unknown_handler = MessageHandler(Filters.command, unknown)
+
+    dispatcher.add_handler(kraljevo_handler)
+    dispatcher.add_handler(start_handler)
+    dispatcher.add_handler(follow_handler)
+    dispatcher.add_handler(unfollow_handler)
+    dispatcher.add_handler(unfollow_all_handler)
+    dispatcher.add_handler(list_handler)
+    dispatcher.add_handler(similarity_handler)
+    dispatcher.add_handler(help_handler)
+    dispatcher.add_handler(end_handler)
+    dispatcher.add_handler(comment_handler)
+    dispatcher.add_handler(list_comments_handler)
+    dispatcher.add_handler(next_page_handler)
+    dispatcher.add_handler(send_a_message_to_users_handler)
+    dispatcher.add_handler(unknown_handler)
+
+    # With monitor workers, this process only keeps its subscription index fresh for /list
+    if MONITOR_MODE == 'workers':
+        job_queuer.run_repeating(lambda context: reload_subscriptions(), interval=SUBSCRIPTIONS_RELOAD_INTERVAL,
+                                 first=SUBSCRIPTIONS_RELOAD_INTERVAL)
+    else:
+        job_queuer.run_repeating(callback_minute, interval=MONITOR_TICK, first=MONITOR_TICK)
+    job_queuer.run_repeating(callback_prune_comments, interval=COMMENT_PRUNE_INTERVAL, first=COMMENT_PRUNE_INTERVAL)
+
+    startup = time.monotonic() - process_started_at
+    STARTUP_SECONDS.set(startup)
+    print_log("Bot started in %.2f seconds, overdue urls spread out: " % startup, overdue)
+
+    updater.start_polling()
+    updater.idle()
+    stop_notification_workers()
+
+
+if __name__ == '__main__':
+    main()
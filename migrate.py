@@ -0,0 +1,80 @@
+import argparse
+import sys
+
+import bot
+from storage import PostgresStorage, StorageError
+
+
+# Moves the data of the old, single table layout (user_data, plus url_state and
+# url_snapshots of the later versions) to the normalized tables: urls, subscriptions
+# and snapshots. Everything is copied in one transaction and the migration can be run
+# again safely. Run it with the bot's environment, e.g. "heroku run python migrate.py".
+def parse_args():
+    parser = argparse.ArgumentParser(description="Migrate the bot's data to the normalized schema.")
+    parser.add_argument('--drop-old', action='store_true',
+                        help="drop the old tables once their data is migrated")
+    return parser.parse_args()
+
+
+def table_exists(cursor, table):
+    cursor.execute("select to_regclass(%s)", ['public.' + table])
+    return cursor.fetchone()[0] is not None
+
+
+def migrate(cursor, drop_old):
+    if not table_exists(cursor, 'user_data'):
+        print("Nothing to migrate, public.user_data does not exist.")
+        return
+
+    # Every distinct url once; subscribers could have had different hashes, any of them will do
+    if table_exists(cursor, 'url_state'):
+        cursor.execute("insert into public.urls (url, hash, etag, last_modified, status, check_interval, next_check) "
+                       "select d.url, d.hash, s.etag, s.last_modified, s.status, s.check_interval, s.next_check "
+                       "from (select distinct on (url) url, hash from public.user_data order by url) d "
+                       "left join public.url_state s on s.url = d.url "
+                       "on conflict (url) do nothing")
+    else:
+        cursor.execute("insert into public.urls (url, hash) "
+                       "select distinct on (url) url, hash from public.user_data order by url "
+                       "on conflict (url) do nothing")
+    print("Urls migrated: ", cursor.rowcount)
+
+    cursor.execute("insert into public.subscriptions (chat_id, url_id) "
+                   "select distinct d.chat_id, u.url_id from public.user_data d "
+                   "join public.urls u on u.url = d.url "
+                   "on conflict do nothing")
+    print("Subscriptions migrated: ", cursor.rowcount)
+
+    if table_exists(cursor, 'url_snapshots'):
+        cursor.execute("insert into public.snapshots (url_id, version, body, is_delta, created_at) "
+                       "select u.url_id, s.version, s.body, s.is_delta, s.created_at from public.url_snapshots s "
+                       "join public.urls u on u.url = s.url "
+                       "on conflict do nothing")
+        print("Snapshots migrated: ", cursor.rowcount)
+
+    if drop_old:
+        cursor.execute("drop table if exists public.url_snapshots, public.url_state, public.user_data")
+        print("Old tables dropped.")
+
+
+def main():
+    args = parse_args()
+
+    if not isinstance(bot.storage, PostgresStorage):
+        sys.exit("Only PostgreSQL databases need to be migrated.")
+
+    # Creates the new tables
+    bot.init_database()
+
+    try:
+        with bot.storage.transaction() as cursor:
+            migrate(cursor, args.drop_old)
+        print("Migration finished.")
+    except StorageError as e:
+        print("Migration failed, nothing was changed: ", e.detail)
+    finally:
+        bot.flush_logs()
+
+
+if __name__ == '__main__':
+    main()
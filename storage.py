@@ -0,0 +1,692 @@
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2 as pscg
+from psycopg2 import pool as pscg_pool
+from psycopg2 import extensions as pscg_extensions
+from psycopg2.extras import execute_values
+
+
+# Storage of the bot's data: urls with their state, subscriptions, page snapshots and comments.
+# There are two interchangeable backends with the same methods, PostgresStorage and
+# SQLiteStorage; open_storage picks one by the database url. Every method runs in its own
+# transaction and raises StorageError if the database fails.
+#
+# Url states are tuples (url_id, url, hash, simhash, etag, last_modified, status, failure_count),
+# times (next_check) are unix timestamps and similarity thresholds are fractions between 0 and 1,
+# None for "every change".
+
+
+class StorageError(Exception):
+    def __init__(self, message, code=None, detail=None):
+        super().__init__(message)
+        self.message = message
+        self.code = code
+        self.detail = detail
+
+
+# Observe is called with the name of the method and the seconds its transaction took, connecting included.
+def open_storage(database_url, sslmode='require', pool_min=1, pool_max=8, timeout=30, health_check_interval=30,
+                 batch_size=1000, log=print, observe=lambda name, seconds: None):
+    if database_url.startswith('sqlite:///'):
+        return SQLiteStorage(database_url[len('sqlite:///'):], timeout, batch_size, log, observe)
+
+    return PostgresStorage(database_url, sslmode, pool_min, pool_max, timeout, health_check_interval, batch_size,
+                           log, observe)
+
+
+class PostgresStorage:
+    schema_queries = [
+        # Every monitored page once: its hash, cache validators (ETag, Last-Modified),
+        # fetch status and adaptive polling schedule
+        "create table if not exists public.urls ("
+        "url_id serial primary key, "
+        "url varchar(1500) not null unique, "
+        "hash varchar(56), "
+        "etag text, "
+        "last_modified text, "
+        "status varchar(20), "
+        "check_interval integer, "
+        "next_check timestamptz)",
+        # Who follows what; the unique index serves the monitor's fan-out by url,
+        # the chat_id index serves /list, /unfollow and /end
+        "create table if not exists public.subscriptions ("
+        "chat_id bigint not null, "
+        "url_id integer not null references public.urls (url_id) on delete cascade)",
+        "create unique index if not exists subscriptions_url_id_chat_id_key "
+        "on public.subscriptions (url_id, chat_id)",
+        "create index if not exists subscriptions_chat_id_idx on public.subscriptions (chat_id)",
+        # Leases of the monitor workers; the index serves their claims of due urls
+        "alter table public.urls add column if not exists lease_owner text",
+        "alter table public.urls add column if not exists lease_until timestamptz",
+        "create index if not exists urls_next_check_idx on public.urls (next_check)",
+        # Failed checks in a row, for the retry backoff and the unreachable notices
+        "alter table public.urls add column if not exists failure_count integer not null default 0",
+        # SimHash of the page text and the similarity below which a follower is notified of a change
+        "alter table public.urls add column if not exists simhash varchar(16)",
+        "alter table public.subscriptions add column if not exists similarity real",
+        # SimHash of the version last reported to a follower with a similarity threshold
+        "alter table public.subscriptions add column if not exists simhash varchar(16)",
+        # Compressed page snapshots, only the latest version of every page. Older versions used to be
+        # kept as deltas (is_delta), they are dropped
+        "create table if not exists public.snapshots ("
+        "url_id integer not null references public.urls (url_id) on delete cascade, "
+        "version integer not null, "
+        "body bytea not null, "
+        "is_delta boolean not null default false, "
+        "created_at timestamptz not null default now(), "
+        "primary key (url_id, version))",
+        "delete from public.snapshots where is_delta",
+        "create table if not exists public.user_comments ("
+        "comment_id serial primary key, "
+        "chat_id bigint not null, "
+        "comment_text text, "
+        "username text, "
+        "first_name text)",
+        # The chat_id index serves the comment quota and /list_comments, the created_at index the pruning
+        "alter table public.user_comments add column if not exists created_at timestamptz not null default now()",
+        "create index if not exists user_comments_chat_id_idx on public.user_comments (chat_id)",
+        "create index if not exists user_comments_created_at_idx on public.user_comments (created_at)",
+    ]
+
+    # Urls that lost their last subscriber
+    orphan_urls_query = "delete from public.urls u where u.url_id = any(%s) " \
+                        "and not exists (select 1 from public.subscriptions s where s.url_id = u.url_id)"
+
+    # Connections come from a pool shared by all handlers and jobs. Connections idle for longer
+    # than health_check_interval seconds are checked before they are handed out.
+    def __init__(self, dsn, sslmode, pool_min, pool_max, timeout, health_check_interval, batch_size, log, observe):
+        self.dsn = dsn
+        self.sslmode = sslmode
+        self.pool_min = pool_min
+        self.pool_max = pool_max
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.batch_size = batch_size
+        self.log = log
+        self.observe = observe
+
+        self.pool = None
+        self.pool_lock = threading.Lock()
+        self.pool_slots = threading.BoundedSemaphore(pool_max)
+        self.last_used = {}
+
+    def get_pool(self):
+        with self.pool_lock:
+            if self.pool is None:
+                self.pool = pscg_pool.ThreadedConnectionPool(self.pool_min, self.pool_max, self.dsn,
+                                                             sslmode=self.sslmode)
+                self.log("Database connection pool created, max connections: ", self.pool_max)
+            return self.pool
+
+    def is_connection_healthy(self, conn):
+        if conn.closed:
+            return False
+
+        # Recently used connections are trusted without a round-trip
+        if time.monotonic() - self.last_used.get(id(conn), 0) < self.health_check_interval:
+            return True
+
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("select 1")
+            conn.rollback()
+            return True
+        except pscg.Error:
+            return False
+
+    def discard_connection(self, conn):
+        self.last_used.pop(id(conn), None)
+        try:
+            self.get_pool().putconn(conn, close=True)
+        except pscg.Error:
+            pass
+
+    # Takes a connection from the pool, waiting for a free one if all are in use.
+    # Broken connections (e.g. after a database restart) are replaced with new ones.
+    # Every connection has to be given back with release_connection.
+    def get_connection(self):
+        if not self.pool_slots.acquire(timeout=self.timeout):
+            raise pscg_pool.PoolError("timed out waiting for a free database connection")
+
+        try:
+            db_pool = self.get_pool()
+
+            # Every idle connection in the pool might be dead, plus one fresh attempt
+            for _ in range(self.pool_max + 1):
+                conn = db_pool.getconn()
+                if self.is_connection_healthy(conn):
+                    return conn
+
+                self.log("Discarding a broken database connection.")
+                self.discard_connection(conn)
+
+            raise pscg_pool.PoolError("could not get a healthy database connection")
+
+        except BaseException:
+            self.pool_slots.release()
+            raise
+
+    def release_connection(self, conn):
+        broken = bool(conn.closed)
+
+        if not broken:
+            try:
+                if conn.get_transaction_status() != pscg_extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except pscg.Error:
+                broken = True
+
+        try:
+            if broken:
+                self.discard_connection(conn)
+            else:
+                self.last_used[id(conn)] = time.monotonic()
+                self.get_pool().putconn(conn)
+        finally:
+            self.pool_slots.release()
+
+    # Runs the block in a transaction on a pooled connection and commits it,
+    # unless the block raises; database errors are raised as StorageError. Name is what it is observed as.
+    @contextmanager
+    def transaction(self, name='transaction'):
+        started = time.monotonic()
+        try:
+            conn = self.get_connection()
+        except pscg.Error as e:
+            raise StorageError("Failed to connect to PostgreSQL database", e.pgcode, e.pgerror or str(e))
+
+        try:
+            with conn.cursor() as cursor:
+                yield cursor
+            conn.commit()
+        except pscg.Error as e:
+            raise StorageError("Failed to execute query", e.pgcode, e.pgerror or str(e))
+        finally:
+            self.release_connection(conn)
+            self.observe(name, time.monotonic() - started)
+
+    # Creates the tables, if they do not exist already.
+    def init_schema(self):
+        with self.transaction('init_schema') as cursor:
+            for schema_query in self.schema_queries:
+                cursor.execute(schema_query)
+
+    # Returns all subscriptions as rows of the url state, check_interval, next_check, chat_id, similarity
+    # and the SimHash of the version last reported to the chat, the url's SimHash if none was reported yet.
+    def load_subscriptions(self):
+        load_query = "select u.url_id, u.url, u.hash, u.simhash, u.etag, u.last_modified, u.status, " \
+                     "u.failure_count, u.check_interval, extract(epoch from u.next_check)::float8, s.chat_id, " \
+                     "s.similarity, coalesce(s.simhash, u.simhash) " \
+                     "from public.urls u join public.subscriptions s on s.url_id = u.url_id order by s.chat_id"
+
+        with self.transaction('load_subscriptions') as cursor:
+            cursor.execute(load_query)
+            return cursor.fetchall()
+
+    # Subscribes the chat to the urls, given as (url, hash, simhash) rows; urls that are not stored yet
+    # are added with their hashes. Returns the states of the urls the chat did not follow before.
+    def add_subscriptions(self, chat_id, rows):
+        # Updating existing urls locks them, so they can not be deleted before the subscriptions are in
+        url_query = "insert into public.urls (url, hash, simhash) values %s " \
+                    "on conflict (url) do update set url = excluded.url " \
+                    "returning url_id, url, hash, simhash, etag, last_modified, status, failure_count"
+        insert_query = "insert into public.subscriptions (chat_id, url_id) values %s " \
+                       "on conflict do nothing returning url_id"
+
+        with self.transaction('add_subscriptions') as cursor:
+            states = {}
+            for state in execute_values(cursor, url_query, rows, page_size=self.batch_size, fetch=True):
+                states[state[0]] = state
+
+            inserted = execute_values(cursor, insert_query, [(chat_id, url_id) for url_id in states],
+                                      page_size=self.batch_size, fetch=True)
+            return [states[url_id] for (url_id,) in inserted]
+
+    # Unsubscribes the chat from the urls, from all of them if urls is None, and deletes
+    # the urls nobody follows anymore. Returns the urls the chat followed.
+    def remove_subscriptions(self, chat_id, urls=None):
+        delete_query = "delete from public.subscriptions s using public.urls u " \
+                       "where s.url_id = u.url_id and s.chat_id = %s"
+        parameters = [chat_id]
+        if urls is not None:
+            delete_query += " and u.url = any(%s)"
+            parameters.append(list(urls))
+
+        with self.transaction('remove_subscriptions') as cursor:
+            cursor.execute(delete_query + " returning u.url_id, u.url", parameters)
+            data = cursor.fetchall()
+            cursor.execute(self.orphan_urls_query, [[url_id for url_id, _ in data]])
+            return [url for _, url in data]
+
+    # Sets the similarity threshold of the chat's subscription to the url, which is compared with the current
+    # version from now on. Returns whether the chat follows it.
+    def set_similarity(self, chat_id, url, similarity):
+        similarity_query = "update public.subscriptions s set similarity = %s, simhash = u.simhash " \
+                           "from public.urls u " \
+                           "where s.url_id = u.url_id and s.chat_id = %s and u.url = %s"
+
+        with self.transaction('set_similarity') as cursor:
+            cursor.execute(similarity_query, [similarity, chat_id, url])
+            return cursor.rowcount > 0
+
+    def subscribed_chat_ids(self):
+        with self.transaction('subscribed_chat_ids') as cursor:
+            cursor.execute("select distinct chat_id from public.subscriptions")
+            return [chat_id for (chat_id,) in cursor.fetchall()]
+
+    # Saves the states of checked urls and releases their leases. Rows are (url_id, hash, simhash, etag,
+    # last_modified, status, failure_count, check_interval, next_check); a missing hash keeps the old
+    # hash and simhash. Baselines are (url_id, chat_id, simhash) rows of the versions reported to followers
+    # with a similarity threshold. With an owner only the urls still leased to it are saved, a url whose
+    # lease expired may have been claimed and checked by another owner meanwhile. Returns the saved url_ids.
+    def save_url_states(self, rows, owner=None, baselines=()):
+        state_query = "update public.urls u set hash = coalesce(v.hash, u.hash), " \
+                      "simhash = case when v.hash is null then u.simhash else v.simhash end, etag = v.etag, " \
+                      "last_modified = v.last_modified, status = v.status, failure_count = v.failure_count, " \
+                      "check_interval = v.check_interval, next_check = to_timestamp(v.next_check), " \
+                      "lease_owner = null, lease_until = null " \
+                      "from (values %s) as v (url_id, hash, simhash, etag, last_modified, status, failure_count, " \
+                      "check_interval, next_check, lease_owner) " \
+                      "where u.url_id = v.url_id and (v.lease_owner is null or u.lease_owner = v.lease_owner) " \
+                      "returning u.url_id"
+
+        baseline_query = "update public.subscriptions s set simhash = v.simhash " \
+                         "from (values %s) as v (url_id, chat_id, simhash) " \
+                         "where s.url_id = v.url_id and s.chat_id = v.chat_id"
+
+        with self.transaction('save_url_states') as cursor:
+            saved = execute_values(cursor, state_query, [row + (owner,) for row in rows], page_size=self.batch_size,
+                                   fetch=True)
+            saved = set(url_id for (url_id,) in saved)
+
+            baselines = [row for row in baselines if row[0] in saved]
+            if baselines:
+                execute_values(cursor, baseline_query, baselines, page_size=self.batch_size)
+            return saved
+
+    # Extends the leases of the urls that are still leased to the owner by lease seconds.
+    def renew_leases(self, owner, url_ids, lease):
+        with self.transaction('renew_leases') as cursor:
+            cursor.execute("update public.urls set lease_until = now() + %s * interval '1 second' "
+                           "where lease_owner = %s and url_id = any(%s)", (lease, owner, list(url_ids)))
+            return cursor.rowcount
+
+    # Leases up to limit due urls to the owner for lease seconds. Rows locked by another owner's
+    # claim are skipped, expired leases are taken over. Returns rows of the url state,
+    # check_interval and the list of (chat_id, similarity, simhash) subscriptions to the url, simhash
+    # as in load_subscriptions.
+    def claim_urls(self, owner, lease, limit):
+        claim_query = "update public.urls u set lease_owner = %s, lease_until = now() + %s * interval '1 second' " \
+                      "from (select url_id from public.urls c where coalesce(c.next_check, '-infinity') <= now() " \
+                      "and (c.lease_until is null or c.lease_until < now()) " \
+                      "and exists (select 1 from public.subscriptions s where s.url_id = c.url_id) " \
+                      "order by c.next_check nulls first limit %s for update skip locked) as c " \
+                      "where u.url_id = c.url_id " \
+                      "returning u.url_id, u.url, u.hash, u.simhash, u.etag, u.last_modified, u.status, " \
+                      "u.failure_count, u.check_interval"
+        lookup_query = "select s.url_id, s.chat_id, s.similarity, coalesce(s.simhash, u.simhash) " \
+                       "from public.subscriptions s join public.urls u on u.url_id = s.url_id where s.url_id = any(%s)"
+
+        with self.transaction('claim_urls') as cursor:
+            cursor.execute(claim_query, (owner, lease, limit))
+            data = cursor.fetchall()
+            if not data:
+                return []
+
+            cursor.execute(lookup_query, [[row[0] for row in data]])
+            subscriptions = {}
+            for url_id, chat_id, similarity, simhash in cursor.fetchall():
+                subscriptions.setdefault(url_id, []).append((chat_id, similarity, simhash))
+
+        return [row + (subscriptions[row[0]],) for row in data if row[0] in subscriptions]
+
+    # Releases the leases of the owner, so that its urls can be claimed again. Returns their number.
+    def release_leases(self, owner):
+        with self.transaction('release_leases') as cursor:
+            cursor.execute("update public.urls set lease_owner = null, lease_until = null where lease_owner = %s",
+                           [owner])
+            return cursor.rowcount
+
+    # Returns a dict url_id -> (version, body) of the latest snapshots of the urls.
+    def load_latest_snapshots(self, url_ids):
+        latest_query = "select url_id, version, body from public.snapshots where url_id = any(%s) and not is_delta"
+
+        with self.transaction('load_latest_snapshots') as cursor:
+            cursor.execute(latest_query, [list(url_ids)])
+            return {url_id: (version, bytes(body)) for url_id, version, body in cursor.fetchall()}
+
+    # Adds the (url_id, version, body) new snapshots and drops the older versions of their urls.
+    def save_snapshots(self, snapshots):
+        insert_query = "insert into public.snapshots (url_id, version, body) values %s"
+        prune_query = "delete from public.snapshots s using (values %s) as v (url_id, version) " \
+                      "where s.url_id = v.url_id and s.version < v.version"
+
+        with self.transaction('save_snapshots') as cursor:
+            execute_values(cursor, insert_query, snapshots, page_size=self.batch_size)
+            execute_values(cursor, prune_query, [(url_id, version) for url_id, version, _ in snapshots],
+                           page_size=self.batch_size)
+
+    # Saves a comment, unless the chat already has limit comments, with one statement.
+    # Returns whether it was saved.
+    def add_comment(self, chat_id, text, username, first_name, limit):
+        insert_query = "insert into public.user_comments (chat_id, comment_text, username, first_name) " \
+                       "select %s, %s, %s, %s " \
+                       "where (select count(*) from public.user_comments where chat_id = %s) < %s"
+
+        with self.transaction('add_comment') as cursor:
+            cursor.execute(insert_query, [chat_id, text, username, first_name, chat_id, limit])
+            return cursor.rowcount > 0
+
+    # Returns (comment_id, comment_text) rows of up to limit of the chat's comments,
+    # in the order they were sent and starting after the comment after_id.
+    def list_comments(self, chat_id, after_id, limit):
+        with self.transaction('list_comments') as cursor:
+            cursor.execute("select comment_id, comment_text from public.user_comments "
+                           "where chat_id = %s and comment_id > %s order by comment_id limit %s",
+                           [chat_id, after_id, limit])
+            return cursor.fetchall()
+
+    def remove_comments(self, chat_id):
+        with self.transaction('remove_comments') as cursor:
+            cursor.execute("delete from public.user_comments where chat_id = %s", [chat_id])
+
+    # Deletes up to limit comments older than max_age seconds, the oldest first. Returns their number.
+    def prune_comments(self, max_age, limit):
+        prune_query = "delete from public.user_comments where comment_id in (" \
+                      "select comment_id from public.user_comments " \
+                      "where created_at < now() - %s * interval '1 second' order by created_at limit %s)"
+
+        with self.transaction('prune_comments') as cursor:
+            cursor.execute(prune_query, [max_age, limit])
+            return cursor.rowcount
+
+
+class SQLiteStorage:
+    schema_queries = [
+        "create table if not exists urls ("
+        "url_id integer primary key, "
+        "url text not null unique, "
+        "hash text, "
+        "simhash text, "
+        "etag text, "
+        "last_modified text, "
+        "status text, "
+        "failure_count integer not null default 0, "
+        "check_interval integer, "
+        "next_check real, "
+        "lease_owner text, "
+        "lease_until real)",
+        "create table if not exists subscriptions ("
+        "chat_id integer not null, "
+        "url_id integer not null references urls (url_id) on delete cascade, "
+        "similarity real, "
+        "simhash text)",
+        "create table if not exists snapshots ("
+        "url_id integer not null references urls (url_id) on delete cascade, "
+        "version integer not null, "
+        "body blob not null, "
+        "is_delta integer not null default 0, "
+        "created_at real not null default (strftime('%s', 'now')), "
+        "primary key (url_id, version))",
+        "delete from snapshots where is_delta",
+        "create table if not exists user_comments ("
+        "comment_id integer primary key autoincrement, "
+        "chat_id integer not null, "
+        "comment_text text, "
+        "username text, "
+        "first_name text, "
+        "created_at real not null default (strftime('%s', 'now')))",
+    ]
+
+    # Columns added after the tables were first released, as (table, column definition);
+    # SQLite can not add a column only if it does not exist
+    schema_columns = [
+        ("urls", "simhash text"),
+        ("subscriptions", "similarity real"),
+        ("subscriptions", "simhash text"),
+        ("user_comments", "created_at real not null default 0"),
+    ]
+
+    # Created once the tables have all their columns
+    index_queries = [
+        "create unique index if not exists subscriptions_url_id_chat_id_key on subscriptions (url_id, chat_id)",
+        "create index if not exists subscriptions_chat_id_idx on subscriptions (chat_id)",
+        "create index if not exists urls_next_check_idx on urls (next_check)",
+        "create index if not exists user_comments_chat_id_idx on user_comments (chat_id)",
+        "create index if not exists user_comments_created_at_idx on user_comments (created_at)",
+    ]
+
+    # Urls that lost their last subscriber
+    orphan_urls_query = "delete from urls where url_id = ? " \
+                        "and not exists (select 1 from subscriptions s where s.url_id = urls.url_id)"
+
+    # Every thread gets its own connection to the database file. In WAL mode readers do not block
+    # the writer and the writer does not block readers; writers wait up to timeout seconds for each other.
+    def __init__(self, path, timeout, batch_size, log, observe):
+        self.path = path
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.log = log
+        self.observe = observe
+        self.local = threading.local()
+
+    def get_connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.execute("pragma journal_mode = wal")
+            conn.execute("pragma synchronous = normal")
+            conn.execute("pragma foreign_keys = on")
+            self.local.conn = conn
+            self.log("SQLite database opened: ", self.path)
+        return conn
+
+    # Runs the block in a transaction and commits it, unless the block raises; database errors
+    # are raised as StorageError. Writing transactions take the write lock up front, so that
+    # they wait for other writers instead of failing halfway. Name is what it is observed as.
+    @contextmanager
+    def transaction(self, name='transaction', write=True):
+        started = time.monotonic()
+        try:
+            conn = self.get_connection()
+        except sqlite3.Error as e:
+            raise StorageError("Failed to open SQLite database", type(e).__name__, str(e))
+
+        try:
+            conn.execute("begin immediate" if write else "begin")
+        except sqlite3.Error as e:
+            raise StorageError("Failed to start a transaction", type(e).__name__, str(e))
+
+        cursor = conn.cursor()
+        try:
+            yield cursor
+            conn.execute("commit")
+        except sqlite3.Error as e:
+            conn.execute("rollback")
+            raise StorageError("Failed to execute query", type(e).__name__, str(e))
+        except BaseException:
+            conn.execute("rollback")
+            raise
+        finally:
+            cursor.close()
+            self.observe(name, time.monotonic() - started)
+
+    # Runs a query with an "in (...)" list for every batch of values; query has one {} for the list.
+    def select_in(self, cursor, query, values, parameters=()):
+        values = list(values)
+        data = []
+        for start in range(0, len(values), self.batch_size):
+            batch = values[start:start + self.batch_size]
+            cursor.execute(query.format(",".join("?" * len(batch))), list(parameters) + batch)
+            data.extend(cursor.fetchall())
+        return data
+
+    def init_schema(self):
+        with self.transaction('init_schema') as cursor:
+            for schema_query in self.schema_queries:
+                cursor.execute(schema_query)
+
+            for table, column in self.schema_columns:
+                cursor.execute("pragma table_info(" + table + ")")
+                if column.split()[0] not in [row[1] for row in cursor.fetchall()]:
+                    cursor.execute("alter table " + table + " add column " + column)
+
+            for index_query in self.index_queries:
+                cursor.execute(index_query)
+
+    def load_subscriptions(self):
+        load_query = "select u.url_id, u.url, u.hash, u.simhash, u.etag, u.last_modified, u.status, " \
+                     "u.failure_count, u.check_interval, u.next_check, s.chat_id, s.similarity, " \
+                     "coalesce(s.simhash, u.simhash) " \
+                     "from urls u join subscriptions s on s.url_id = u.url_id order by s.chat_id"
+
+        with self.transaction('load_subscriptions', write=False) as cursor:
+            cursor.execute(load_query)
+            return cursor.fetchall()
+
+    def add_subscriptions(self, chat_id, rows):
+        with self.transaction('add_subscriptions') as cursor:
+            cursor.executemany("insert into urls (url, hash, simhash) values (?, ?, ?) on conflict (url) do nothing",
+                               rows)
+            states = self.select_in(cursor, "select url_id, url, hash, simhash, etag, last_modified, status, "
+                                            "failure_count from urls where url in ({})", [row[0] for row in rows])
+
+            inserted = []
+            for state in states:
+                cursor.execute("insert into subscriptions (chat_id, url_id) values (?, ?) on conflict do nothing",
+                               [chat_id, state[0]])
+                if cursor.rowcount:
+                    inserted.append(state)
+            return inserted
+
+    def remove_subscriptions(self, chat_id, urls=None):
+        lookup_query = "select u.url_id, u.url from subscriptions s join urls u on u.url_id = s.url_id " \
+                       "where s.chat_id = ?"
+
+        with self.transaction('remove_subscriptions') as cursor:
+            if urls is None:
+                cursor.execute(lookup_query, [chat_id])
+                data = cursor.fetchall()
+            else:
+                data = self.select_in(cursor, lookup_query + " and u.url in ({})", urls, [chat_id])
+
+            cursor.executemany("delete from subscriptions where chat_id = ? and url_id = ?",
+                               [(chat_id, url_id) for url_id, _ in data])
+            cursor.executemany(self.orphan_urls_query, [(url_id,) for url_id, _ in data])
+            return [url for _, url in data]
+
+    def set_similarity(self, chat_id, url, similarity):
+        similarity_query = "update subscriptions set similarity = ?1, " \
+                           "simhash = (select simhash from urls where url = ?3) " \
+                           "where chat_id = ?2 and url_id = (select url_id from urls where url = ?3)"
+
+        with self.transaction('set_similarity') as cursor:
+            cursor.execute(similarity_query, [similarity, chat_id, url])
+            return cursor.rowcount > 0
+
+    def subscribed_chat_ids(self):
+        with self.transaction('subscribed_chat_ids', write=False) as cursor:
+            cursor.execute("select distinct chat_id from subscriptions")
+            return [chat_id for (chat_id,) in cursor.fetchall()]
+
+    def save_url_states(self, rows, owner=None, baselines=()):
+        state_query = "update urls set simhash = case when ?1 is null then simhash else ?2 end, " \
+                      "hash = coalesce(?1, hash), etag = ?3, last_modified = ?4, status = ?5, " \
+                      "failure_count = ?6, check_interval = ?7, next_check = ?8, " \
+                      "lease_owner = null, lease_until = null where url_id = ?9"
+
+        with self.transaction('save_url_states') as cursor:
+            if owner is not None:
+                leased = set(url_id for (url_id,) in self.select_in(
+                    cursor, "select url_id from urls where lease_owner = ? and url_id in ({})",
+                    [row[0] for row in rows], [owner]))
+                rows = [row for row in rows if row[0] in leased]
+
+            cursor.executemany(state_query, [row[1:] + (row[0],) for row in rows])
+            saved = set(row[0] for row in rows)
+
+            cursor.executemany("update subscriptions set simhash = ? where url_id = ? and chat_id = ?",
+                               [(simhash, url_id, chat_id) for url_id, chat_id, simhash in baselines
+                                if url_id in saved])
+            return saved
+
+    def renew_leases(self, owner, url_ids, lease):
+        with self.transaction('renew_leases') as cursor:
+            until = time.time() + lease
+            cursor.executemany("update urls set lease_until = ? where lease_owner = ? and url_id = ?",
+                               [(until, owner, url_id) for url_id in url_ids])
+            return cursor.rowcount
+
+    # The write lock is held from the select to the update, so no two owners claim the same url.
+    def claim_urls(self, owner, lease, limit):
+        now = time.time()
+        due_query = "select url_id from urls c where coalesce(c.next_check, 0) <= ? " \
+                    "and (c.lease_until is null or c.lease_until < ?) " \
+                    "and exists (select 1 from subscriptions s where s.url_id = c.url_id) " \
+                    "order by c.next_check limit ?"
+
+        with self.transaction('claim_urls') as cursor:
+            cursor.execute(due_query, [now, now, limit])
+            url_ids = [url_id for (url_id,) in cursor.fetchall()]
+            if not url_ids:
+                return []
+
+            cursor.executemany("update urls set lease_owner = ?, lease_until = ? where url_id = ?",
+                               [(owner, now + lease, url_id) for url_id in url_ids])
+            data = self.select_in(cursor, "select url_id, url, hash, simhash, etag, last_modified, status, "
+                                          "failure_count, check_interval from urls where url_id in ({})", url_ids)
+
+            subscriptions = {}
+            for url_id, chat_id, similarity, simhash in self.select_in(
+                    cursor, "select s.url_id, s.chat_id, s.similarity, coalesce(s.simhash, u.simhash) "
+                            "from subscriptions s join urls u on u.url_id = s.url_id where s.url_id in ({})", url_ids):
+                subscriptions.setdefault(url_id, []).append((chat_id, similarity, simhash))
+
+        return [row + (subscriptions[row[0]],) for row in data if row[0] in subscriptions]
+
+    def release_leases(self, owner):
+        with self.transaction('release_leases') as cursor:
+            cursor.execute("update urls set lease_owner = null, lease_until = null where lease_owner = ?", [owner])
+            return cursor.rowcount
+
+    def load_latest_snapshots(self, url_ids):
+        with self.transaction('load_latest_snapshots', write=False) as cursor:
+            data = self.select_in(cursor, "select url_id, version, body from snapshots "
+                                          "where url_id in ({}) and not is_delta", url_ids)
+            return {url_id: (version, body) for url_id, version, body in data}
+
+    def save_snapshots(self, snapshots):
+        with self.transaction('save_snapshots') as cursor:
+            cursor.executemany("insert into snapshots (url_id, version, body) values (?, ?, ?)", snapshots)
+            cursor.executemany("delete from snapshots where url_id = ? and version < ?",
+                               [(url_id, version) for url_id, version, _ in snapshots])
+
+    def add_comment(self, chat_id, text, username, first_name, limit):
+        insert_query = "insert into user_comments (chat_id, comment_text, username, first_name, created_at) " \
+                       "select ?, ?, ?, ?, ? where (select count(*) from user_comments where chat_id = ?) < ?"
+
+        with self.transaction('add_comment') as cursor:
+            cursor.execute(insert_query, [chat_id, text, username, first_name, time.time(), chat_id, limit])
+            return cursor.rowcount > 0
+
+    def list_comments(self, chat_id, after_id, limit):
+        with self.transaction('list_comments', write=False) as cursor:
+            cursor.execute("select comment_id, comment_text from user_comments "
+                           "where chat_id = ? and comment_id > ? order by comment_id limit ?",
+                           [chat_id, after_id, limit])
+            return cursor.fetchall()
+
+    def remove_comments(self, chat_id):
+        with self.transaction('remove_comments') as cursor:
+            cursor.execute("delete from user_comments where chat_id = ?", [chat_id])
+
+    def prune_comments(self, max_age, limit):
+        prune_query = "delete from user_comments where comment_id in (" \
+                      "select comment_id from user_comments where created_at < ? order by created_at limit ?)"
+
+        with self.transaction('prune_comments') as cursor:
+            cursor.execute(prune_query, [time.time() - max_age, limit])
+            return cursor.rowcount